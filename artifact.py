@@ -0,0 +1,132 @@
+"""Compact, lazily loaded export of the fitted model.
+
+The directory holds metadata.json (feature schema, the columns in the order the
+trees were fitted on, LINE categories, baseline) and one .npy file per node
+attribute of the concatenated HGB trees. The arrays
+are only memory-mapped when the first prediction is made, and nothing from
+skrub, ibis or the data-access pipeline is needed to load them.
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from features import FEATURE_SCHEMA_VERSION
+
+ARTIFACT_FORMAT = 2
+ARTIFACT_DIR = Path("model-artifact")
+_NODE_FIELDS = {
+    "feature_idx": np.int32,
+    "num_threshold": np.float64,
+    "missing_go_to_left": np.bool_,
+    "left": np.int32,
+    "right": np.int32,
+    "is_leaf": np.bool_,
+    "value": np.float64,
+}
+
+
+def feature_names(features):
+    # columns seen by the HGB in train.py: the encoded LINE and the features.
+    # The pipeline decides their order, export_model() records it.
+    dropped = ("DAY", "LINE", "LINE_NAME")
+    return ["LINE"] + [c for c in features.columns if c not in dropped]
+
+
+def feature_schema(features):
+    return {"version": FEATURE_SCHEMA_VERSION, "names": feature_names(features)}
+
+
+def export_model(hgb, line_categories, schema, path=ARTIFACT_DIR):
+    if hgb.loss != "squared_error":
+        raise ValueError(f"Cannot export an HGB with loss {hgb.loss!r}")
+    names = [str(c) for c in getattr(hgb, "feature_names_in_", schema["names"])]
+    if sorted(names) != sorted(schema["names"]):
+        raise ValueError("The model was not fitted on the given feature schema")
+    predictors = [p for predictors in hgb._predictors for p in predictors]
+    if any(p.nodes["is_categorical"].any() for p in predictors):
+        raise ValueError("Categorical splits are not supported")
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    sizes = [len(p.nodes) for p in predictors]
+    roots = np.cumsum([0] + sizes[:-1])
+    nodes = np.concatenate([p.nodes for p in predictors])
+    for field, dtype in _NODE_FIELDS.items():
+        values = nodes[field].astype(dtype)
+        if field in ("left", "right"):
+            # children indices become positions in the concatenated arrays
+            values += np.repeat(roots, sizes).astype(dtype)
+        np.save(path / f"{field}.npy", values)
+    np.save(path / "roots.npy", roots.astype(np.int64))
+    metadata = {
+        "format": ARTIFACT_FORMAT,
+        "feature_schema": schema,
+        "feature_names": names,
+        "line_categories": [str(c) for c in line_categories],
+        "baseline": float(np.ravel(hgb._baseline_prediction)[0]),
+    }
+    (path / "metadata.json").write_text(json.dumps(metadata, indent=2))
+
+
+class CompactModel:
+    def __init__(self, path, metadata):
+        self.path = path
+        self.metadata = metadata
+        self.line_codes = {
+            line: i for i, line in enumerate(metadata["line_categories"])
+        }
+        self._arrays = None
+
+    def _nodes(self):
+        if self._arrays is None:
+            self._arrays = {
+                field: np.load(self.path / f"{field}.npy", mmap_mode="r")
+                for field in [*_NODE_FIELDS, "roots"]
+            }
+        return self._arrays
+
+    def predict(self, X):
+        # X: polars dataframe with the columns of the feature schema, LINE
+        # still as a string
+        names = self.metadata["feature_names"]
+        X = X.with_columns(
+            pl.col("LINE").replace_strict(
+                self.line_codes, default=None, return_dtype=pl.Float64
+            )
+        )
+        X = X.select(names).cast(pl.Float64).to_numpy()
+        nodes = self._nodes()
+        out = np.full(X.shape[0], self.metadata["baseline"])
+        rows = np.arange(X.shape[0])
+        for root in nodes["roots"]:
+            current = np.full(X.shape[0], root)
+            active = ~nodes["is_leaf"][current]
+            while active.any():
+                idx = rows[active]
+                node = current[idx]
+                x = X[idx, nodes["feature_idx"][node]]
+                go_left = np.where(
+                    np.isnan(x),
+                    nodes["missing_go_to_left"][node],
+                    x <= nodes["num_threshold"][node],
+                )
+                current[idx] = np.where(
+                    go_left, nodes["left"][node], nodes["right"][node]
+                )
+                active[idx] = ~nodes["is_leaf"][current[idx]]
+            out += nodes["value"][current]
+        return out
+
+
+def load_model(schema, path=ARTIFACT_DIR):
+    path = Path(path)
+    metadata = json.loads((path / "metadata.json").read_text())
+    if metadata["format"] != ARTIFACT_FORMAT:
+        raise ValueError(f"Unsupported artifact format {metadata['format']}")
+    if metadata["feature_schema"] != schema:
+        raise ValueError(
+            "The model artifact was exported for a different feature schema: "
+            f"{metadata['feature_schema']} != {schema}"
+        )
+    return CompactModel(path, metadata)
@@ -0,0 +1,45 @@
+"""Train time and peak memory of one global model as the number of lines grows.
+
+    python benchmarks/bench_global_model.py --n_lines 10 100 1000 2000
+"""
+import argparse
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.preprocessing import OrdinalEncoder
+
+from features import build_features
+from generate_data import daily_counts
+from measure import measure
+
+
+def prepare(n_lines, n_days):
+    counts = daily_counts(n_lines, n_days)
+    features = build_features(counts).drop("LINE_NAME").collect()
+    data = counts.select("DAY", "LINE", "N").join(features, on=["DAY", "LINE"])
+    encoder = OrdinalEncoder()
+    X = data.drop("DAY", "N").with_columns(
+        LINE=encoder.fit_transform(data.select("LINE"))[:, 0]
+    )
+    return X, data["N"]
+
+
+def prepare_and_fit(n_lines, n_days):
+    X, y = prepare(n_lines, n_days)
+    HistGradientBoostingRegressor(max_iter=200, early_stopping=False).fit(X, y)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_lines", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--n_days", type=int, default=3650)
+    args = parser.parse_args()
+    print(f"{'lines':>8}{'prepare s':>12}{'fit s':>10}{'peak MiB':>10}")
+    for n_lines in args.n_lines:
+        prepare_time, _ = measure(prepare, n_lines, args.n_days)
+        total_time, peak = measure(prepare_and_fit, n_lines, args.n_days)
+        fit_time = total_time - prepare_time
+        print(f"{n_lines:>8}{prepare_time:>12.1f}{fit_time:>10.1f}{peak:>10.0f}")
@@ -0,0 +1,62 @@
+"""Compare the DAY x LINE cross-join grid with the per-line grid.
+
+    python benchmarks/bench_grid.py --n_lines 100 1000 4000 --n_days 3650
+"""
+import argparse
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+import polars as pl
+
+import features
+from generate_data import daily_counts
+from measure import measure
+
+
+def cross_join_grid(counts):
+    # every day of the period crossed with every line
+    days = counts.select(
+        pl.date_range(
+            pl.col("DAY").min(),
+            pl.col("DAY").max() + pl.duration(days=features.GRID_EXTENSION_DAYS),
+        ).alias("DAY")
+    )
+    points = days.join(counts.select(pl.col("LINE").unique()), how="cross")
+    return points.join(counts, on=["DAY", "LINE"], how="left")
+
+
+def make_counts(n_lines, n_days):
+    # the untimed setup of every benchmark
+    return daily_counts(n_lines, n_days)
+
+
+def cross_join(counts):
+    grid = cross_join_grid(counts.lazy())
+    return features.add_lagged_features(grid).collect().height
+
+
+def per_line(counts):
+    grid = features.line_time_grid(counts)
+    return features.add_lagged_features(grid).collect().height
+
+
+def per_line_streaming(counts):
+    grid = features.line_time_grid(counts)
+    return features.add_lagged_features(grid).collect(engine="streaming").height
+
+
+BENCHMARKS = [cross_join, per_line, per_line_streaming]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_lines", type=int, nargs="+", default=[100, 1000, 4000])
+    parser.add_argument("--n_days", type=int, default=3650)
+    args = parser.parse_args()
+    print(f"{'benchmark':<20}{'lines':>8}{'seconds':>10}{'peak MiB':>10}")
+    for n_lines in args.n_lines:
+        for func in BENCHMARKS:
+            duration, peak = measure(func, n_lines, args.n_days, setup=make_counts)
+            print(f"{func.__name__:<20}{n_lines:>8}{duration:>10.2f}{peak:>10.0f}")
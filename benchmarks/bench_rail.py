@@ -0,0 +1,53 @@
+"""Training time and peak memory of the stop-level models as the number of stops
+grows, with all stops in one partition or spread over rail.N_BUCKETS.
+
+    python benchmarks/bench_rail.py --n_stops 1000 5000 20000 --n_days 730
+"""
+import argparse
+from pathlib import Path
+import sys
+import tempfile
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+import ibis
+
+import generate_data
+from measure import measure
+import rail
+
+
+def make_data(workdir, n_stops, n_days, n_buckets):
+    counts = generate_data.daily_counts(n_stops, n_days).rename(
+        {"LINE": "STOP", "LINE_NAME": "STOP_NAME"}
+    )
+    database = workdir / "bench.duckdb"
+    con = ibis.duckdb.connect(database)
+    years = counts["DAY"].dt.year()
+    con.create_table(
+        "school_holidays", generate_data.school_holidays(years.min() - 1, years.max())
+    )
+    con.create_table(
+        "holidays", generate_data.public_holidays(years.min(), years.max())
+    )
+    data_dir = workdir / f"stops-{n_buckets}"
+    rail.export_stop_counts(con, ibis.memtable(counts), data_dir, n_buckets)
+    con.disconnect()
+    return database, data_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_stops", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--n_days", type=int, default=730)
+    args = parser.parse_args()
+    print(f"{'stops':>8}{'buckets':>9}{'train s':>10}{'peak MiB':>10}")
+    for n_stops in args.n_stops:
+        for n_buckets in [1, rail.N_BUCKETS]:
+            with tempfile.TemporaryDirectory() as workdir:
+                workdir = Path(workdir)
+                database, data_dir = make_data(workdir, n_stops, args.n_days, n_buckets)
+                duration, peak = measure(
+                    rail.train, 1, database, data_dir, workdir / "models"
+                )
+            print(f"{n_stops:>8}{n_buckets:>9}{duration:>10.1f}{peak:>10.0f}")
@@ -0,0 +1,60 @@
+"""Compare prediction latency of serve.py with one run of predict.py per query.
+
+Start the server first (python serve.py), then from the repository root:
+
+    python benchmarks/bench_serve.py 2023-01-02
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+
+def percentiles(durations):
+    quantiles = statistics.quantiles(durations, n=100)
+    return quantiles[49], quantiles[98]
+
+
+def bench_server(url, date, line, n_queries, batch_size):
+    session = requests.Session()
+    query = {"DAY": [date] * batch_size, "LINE": [line] * batch_size}
+    durations = []
+    for _ in range(n_queries):
+        start = time.perf_counter()
+        response = session.post(url, json=query)
+        response.raise_for_status()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def bench_script(date, n_queries):
+    durations = []
+    for _ in range(n_queries):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "predict.py", date], check=True)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("date")
+    parser.add_argument("--line", default="100__112__12")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--n_queries", type=int, default=200)
+    parser.add_argument("--n_script_runs", type=int, default=5)
+    parser.add_argument("--batch_size", type=int, default=1)
+    args = parser.parse_args()
+
+    results = {
+        f"server (batch of {args.batch_size})": bench_server(
+            args.url, args.date, args.line, args.n_queries, args.batch_size
+        ),
+        "predict.py": bench_script(args.date, args.n_script_runs),
+    }
+    for name, durations in results.items():
+        p50, p99 = percentiles(durations)
+        print(f"{name:<25} p50: {p50 * 1000:10.1f} ms   p99: {p99 * 1000:10.1f} ms")
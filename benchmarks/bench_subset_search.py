@@ -0,0 +1,50 @@
+"""Wall time of the subset/ randomized search with and without the feature cache.
+
+Needs the parquet dataset (python download.py --export_dataset):
+
+    python benchmarks/bench_subset_search.py --n_iter 32 --n_jobs 8
+"""
+import argparse
+import os
+from pathlib import Path
+import shutil
+import sys
+
+SUBSET_DIR = Path(__file__).parents[1] / "subset"
+sys.path.insert(0, str(SUBSET_DIR))
+
+from measure import measure
+
+
+def run_search(use_cache, line_name, n_iter, n_jobs):
+    # the joblib workers inherit the environment variable
+    os.environ["SUBSET_FEATURE_CACHE"] = "1" if use_cache else "0"
+    import utils
+
+    usage = utils.load_usage(line_name).collect()
+    search = utils.get_predictor(line_name).skb.make_randomized_search(
+        scoring="neg_median_absolute_error",
+        cv=utils.Splitter(),
+        n_iter=n_iter,
+        n_jobs=n_jobs,
+        random_state=0,
+    )
+    search.fit({"data": usage})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--line_name", default="T2")
+    parser.add_argument("--n_iter", type=int, default=32)
+    parser.add_argument("--n_jobs", type=int, default=8)
+    args = parser.parse_args()
+    shutil.rmtree(SUBSET_DIR / "feature_cache", ignore_errors=True)
+    for name, use_cache in [
+        ("no cache", False),
+        ("cold cache", True),
+        ("warm cache", True),
+    ]:
+        duration, _ = measure(
+            run_search, use_cache, args.line_name, args.n_iter, args.n_jobs
+        )
+        print(f"{name:<12}{duration:>10.1f}s")
@@ -0,0 +1,33 @@
+"""Wall time of train.py with different numbers of jobs, on the data in data/.
+
+Each run overwrites search-model.pickle and best-model.pickle.
+
+    python benchmarks/bench_train_n_jobs.py --n_jobs 1 -1
+"""
+import argparse
+from pathlib import Path
+import subprocess
+import sys
+import time
+
+ROOT = Path(__file__).parents[1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_jobs", type=int, nargs="+", default=[1, -1])
+    parser.add_argument("train_args", nargs="*")
+    args = parser.parse_args()
+    durations = {}
+    for n_jobs in args.n_jobs:
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "train.py", "--n_jobs", str(n_jobs), *args.train_args],
+            cwd=ROOT,
+            check=True,
+        )
+        durations[n_jobs] = time.perf_counter() - start
+    reference = durations[args.n_jobs[0]]
+    for n_jobs, duration in durations.items():
+        speedup = reference / duration
+        print(f"n_jobs={n_jobs:<4}{duration:>10.1f}s  speedup: {speedup:.1f}x")
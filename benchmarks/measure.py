@@ -0,0 +1,52 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import resource
+import time
+
+
+def _status_mib(field):
+    with open("/proc/self/status") as stream:
+        for line in stream:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) / 1024
+    raise OSError(f"no {field} in /proc/self/status")
+
+
+def _reset_peak():
+    # resets the peak RSS of the process (VmHWM) to its current RSS on Linux;
+    # returns the RSS, or None where that is not possible
+    try:
+        with open("/proc/self/clear_refs", "w") as stream:
+            stream.write("5")
+        return _status_mib("VmRSS")
+    except OSError:
+        return None
+
+
+def _max_rss_mib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run(func, args, setup):
+    if setup is not None:
+        args = (setup(*args),)
+    # the imports and the setup are resident before the call: only the memory
+    # the call adds on top of them is reported
+    start_rss = _reset_peak()
+    start_max_rss = _max_rss_mib()
+    start = time.perf_counter()
+    func(*args)
+    duration = time.perf_counter() - start
+    if start_rss is not None:
+        return duration, _status_mib("VmHWM") - start_rss
+    # without /proc, only a peak above the one of the setup is seen
+    return duration, max(0.0, _max_rss_mib() - start_max_rss)
+
+
+def measure(func, *args, setup=None):
+    # each measurement runs in a fresh process; returns (seconds, peak RSS in
+    # MiB above the RSS at the start of the call). When given, setup(*args)
+    # runs first, untimed and unmeasured, and its result is passed to func.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(1, mp_context=context) as pool:
+        return pool.submit(_run, func, args, setup).result()
@@ -0,0 +1,214 @@
+"""Time and peak memory of each stage of the pipeline on synthetic data.
+
+    python benchmarks/run.py --scale small --save_baseline   # reference numbers
+    python benchmarks/run.py --scale small                   # compare with them
+
+Every stage runs in a fresh process (see measure.py); its setup (opening the
+database, fitting the model used for prediction...) is neither timed nor
+counted in the peak memory, which is the peak RSS of the stage above the RSS
+at its start. The baselines are machine-specific and stored in
+benchmarks/baseline.json.
+"""
+import argparse
+from datetime import timedelta
+import json
+from pathlib import Path
+import sys
+import tempfile
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+import duckdb
+import polars as pl
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.preprocessing import OrdinalEncoder
+
+import data_access
+import download
+import features
+from evaluation import Splitter
+import generate_data
+from measure import measure
+
+BASELINE = Path(__file__).parent / "baseline.json"
+# memory changes are relative to at least this many MiB, so that stages that
+# allocate little are not flagged for a few MiB
+MIN_PEAK_MIB = 16
+# lines, days, ticket categories per line and day
+SCALES = {
+    "small": (50, 730, 5),
+    "medium": (500, 1825, 5),
+    "large": (2000, 3650, 5),
+}
+
+
+def make_data(workdir, n_lines, n_days, n_categories):
+    validations = generate_data.surface_validations(n_lines, n_days, n_categories)
+    csv = workdir / "NB_SURFACE.txt"
+    csv.write_bytes(validations.write_csv(separator=";").encode("latin-1"))
+    con = duckdb.connect(workdir / "bench.duckdb")
+    ingest(workdir, con)
+    download._create_daily_line_counts(con)
+    download._refresh_daily_line_counts(con, changed_days_only=False)
+    years = validations["JOUR"].dt.year()
+    con.register("school", generate_data.school_holidays(years.min() - 1, years.max()))
+    con.register("days_off", generate_data.public_holidays(years.min(), years.max()))
+    con.sql("CREATE TABLE school_holidays AS SELECT * FROM school")
+    con.sql("CREATE TABLE holidays AS SELECT * FROM days_off")
+    con.close()
+
+
+def connect_copy(workdir):
+    # a writable copy so that stages which write do not change the reference
+    target = workdir / "stage.duckdb"
+    target.write_bytes((workdir / "bench.duckdb").read_bytes())
+    return duckdb.connect(target)
+
+
+def ingest(workdir, con=None):
+    con = con if con is not None else duckdb.connect(workdir / "ingest.duckdb")
+    source = download._read_csv(
+        workdir / "NB_SURFACE.txt", ";", download._column_types("rs")
+    )
+    con.sql(f"CREATE OR REPLACE TABLE surface AS SELECT * FROM {source}")
+
+
+def daily_aggregation(con):
+    download._refresh_daily_line_counts(con, changed_days_only=False)
+
+
+def load_counts(con):
+    data_access.load_surface(con).to_polars()
+
+
+def grid(con):
+    features.line_time_grid(data_access.load_surface(con).to_polars()).collect()
+
+
+def surface_features(con):
+    data_access.load_surface_features(con).collect()
+
+
+def connect(workdir):
+    return data_access.connect(workdir / "bench.duckdb")
+
+
+def all_days(workdir):
+    return data_access.load_surface(connect(workdir)).to_polars()
+
+
+def cv_split(all_days):
+    for train, test in Splitter().split(all_days):
+        pass
+
+
+def training_frame(workdir):
+    con = connect(workdir)
+    data = data_access.load_surface(con).to_polars().select("DAY", "LINE", "N")
+    data = data.join(
+        data_access.load_surface_features(con).collect(), on=["DAY", "LINE"]
+    ).sort("DAY", "LINE")
+    encoder = OrdinalEncoder(
+        unknown_value=float("nan"), handle_unknown="use_encoded_value"
+    ).fit(data.select("LINE"))
+    return con, encoder, _encode(data, encoder), data["N"]
+
+
+def _encode(data, encoder):
+    X = data.drop("DAY", "N", "LINE_NAME", strict=False)
+    return X.with_columns(LINE=encoder.transform(X.select("LINE"))[:, 0])
+
+
+def _fit(X, y):
+    return HistGradientBoostingRegressor(max_iter=100, early_stopping=False).fit(X, y)
+
+
+def train(state):
+    _, _, X, y = state
+    _fit(X, y)
+
+
+def fitted_model(workdir):
+    con, encoder, X, y = training_frame(workdir)
+    last_day = data_access.load_surface(con).DAY.max().execute().date()
+    return con, encoder, _fit(X, y), last_day
+
+
+def _predict(state, keys):
+    con, encoder, model, _ = state
+    points = data_access.load_surface_features_at(con, keys)
+    model.predict(_encode(points, encoder))
+
+
+def predict_single(state):
+    con, _, _, last_day = state
+    # a line observed on the last day, so that the next day has features
+    surface = data_access.load_surface(con)
+    line = surface.filter(surface.DAY == last_day).LINE.max().execute()
+    keys = pl.DataFrame({"DAY": [last_day + timedelta(days=1)], "LINE": [line]})
+    _predict(state, keys)
+
+
+def predict_batch(state):
+    con, _, _, last_day = state
+    lines = data_access.load_surface(con).select("LINE").distinct().to_polars()
+    week = pl.date_range(
+        last_day + timedelta(days=1), last_day + timedelta(days=7), eager=True
+    )
+    days = pl.DataFrame({"DAY": week})
+    _predict(state, days.join(lines, how="cross"))
+
+
+# name -> (function, untimed setup); all functions take the working directory
+STAGES = {
+    "ingest": (ingest, None),
+    "daily_aggregation": (daily_aggregation, connect_copy),
+    "load_counts": (load_counts, connect),
+    "grid": (grid, connect),
+    "features": (surface_features, connect),
+    "cv_split": (cv_split, all_days),
+    "train": (train, training_frame),
+    "predict_single": (predict_single, fitted_model),
+    "predict_batch": (predict_batch, fitted_model),
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=None)
+    parser.add_argument("--save_baseline", action="store_true")
+    # relative slowdown (or memory increase) reported as a regression
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    baselines = json.loads(BASELINE.read_text()) if BASELINE.is_file() else {}
+    baseline = baselines.get(args.scale, {})
+    results = {}
+    regressions = []
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        print(f"{args.scale}: {SCALES[args.scale]} lines, days, categories")
+        make_data(workdir, *SCALES[args.scale])
+        for name in args.stages or STAGES:
+            func, setup = STAGES[name]
+            duration, memory = measure(func, workdir, setup=setup)
+            results[name] = {"seconds": duration, "peak_mib": memory}
+            line = f"{name:<20}{duration:>10.3f} s{memory:>10.0f} MiB"
+            if name in baseline:
+                ref = baseline[name]
+                slower = duration / ref["seconds"] - 1
+                bigger = (memory - ref["peak_mib"]) / max(ref["peak_mib"], MIN_PEAK_MIB)
+                line += f"{slower:>+10.0%}{bigger:>+10.0%}"
+                if max(slower, bigger) > args.tolerance:
+                    regressions.append(name)
+                    line += "  REGRESSION"
+            print(line)
+
+    if args.save_baseline:
+        baselines[args.scale] = {**baseline, **results}
+        BASELINE.write_text(json.dumps(baselines, indent=2))
+        print(f"Baseline saved to {BASELINE}")
+    elif regressions:
+        print(f"Regressions (> {args.tolerance:.0%}): {', '.join(regressions)}")
+        sys.exit(1)
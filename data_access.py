@@ -1,31 +1,88 @@
+from datetime import timedelta
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+
 import ibis
 from ibis import _
 import polars as pl
 
+import features
+from features import (
+    AVG_LAG,
+    AVG_WIDTHS,
+    FEATURE_SCHEMA_VERSION,
+    GRID_EXTENSION_DAYS,
+    LAGS,
+    MIN_LAG,
+)
+import tracing
 
-def add_school_holidays(surface, con):
-    holidays = con.table("school_holidays")
-    paris = holidays.filter(_.location == "Paris", _.population.isin(["-", "Élèves"]))
-    start = paris.select(
-        date=_.start_date.cast("date"),
-        is_school_holiday=1,
-    )
-    end = paris.select(
-        date=_.end_date.cast("date"),
-        is_school_holiday=0,
-    )
-    holiday_events = start.union(end).order_by(_.date.asc())
-    return surface.asof_join(holiday_events, holiday_events.date <= surface.DAY).drop(
-        "date"
+# the duckdb file written by download.py, or a directory written by
+# export_dataset()
+DATABASE = Path(
+    os.environ.get("RATP_DATABASE", Path(__file__).parent / "data" / "ratp.duckdb")
+)
+DATASET_DIR = Path(__file__).parent / "data" / "dataset"
+FEATURE_CACHE_DIR = Path(__file__).parent / "data" / "feature_cache"
+MAX_CACHED_FEATURE_TABLES = 8
+
+
+def connect(database=DATABASE):
+    if Path(database).is_dir():
+        return connect_dataset(database)
+    return ibis.duckdb.connect(database, read_only=True)
+
+
+def connect_dataset(path=DATASET_DIR):
+    # In-memory connection with views over the parquet files: filters on LINE
+    # or DAY only read the matching partitions, and any number of processes
+    # can read the files while download.py holds the database file.
+    con = ibis.duckdb.connect()
+    con.raw_sql(
+        "CREATE VIEW daily_counts AS SELECT * FROM "
+        f"read_parquet('{path}/daily_counts/*/*/*.parquet', hive_partitioning=true)"
     )
+    for table_name in ["school_holidays", "holidays"]:
+        con.raw_sql(
+            f"CREATE VIEW {table_name} AS "
+            f"SELECT * FROM read_parquet('{path}/{table_name}.parquet')"
+        )
+    return con
 
 
-def add_holidays(surface, con):
-    holidays = con.table("holidays")
-    return surface.mutate(is_holiday=surface.DAY.isin(holidays.date))
+def export_dataset(con, out_dir=DATASET_DIR):
+    # the cleaned daily counts of load_surface() partitioned by YEAR and LINE,
+    # and the holiday tables, for connect_dataset()
+    tmp_dir = out_dir.with_name(f"{out_dir.name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    # the sums of duckdb are HUGEINT, which parquet stores as doubles; ibis
+    # types them as int64 and would skip a cast to int64
+    counts = con.sql(
+        "SELECT * REPLACE (CAST(N AS BIGINT) AS N) "
+        f"FROM ({con.compile(load_surface(con))})"
+    )
+    counts = counts.mutate(YEAR=_.DAY.year()).order_by("LINE", "DAY")
+    con.to_parquet(counts, tmp_dir / "daily_counts", partition_by=("YEAR", "LINE"))
+    for table_name in ["school_holidays", "holidays"]:
+        con.to_parquet(con.table(table_name), tmp_dir / f"{table_name}.parquet")
+    shutil.rmtree(out_dir, ignore_errors=True)
+    tmp_dir.replace(out_dir)
 
 
 def load_surface(con):
+    tables = con.list_tables()
+    if "daily_counts" in tables:
+        # parquet dataset, see connect_dataset()
+        counts = con.table("daily_counts")
+        return counts.select("DAY", "LINE", "N", "LINE_NAME").order_by(["DAY", "LINE"])
+    if "daily_line_counts" in tables:
+        # materialized by download.py with the same cleaning as below
+        counts = con.table("daily_line_counts").join(con.table("lines"), "LINE_ID")
+        return counts.select("DAY", "LINE", "N", "LINE_NAME").order_by(["DAY", "LINE"])
     surface = con.table("surface")
     surface = surface.mutate(
         N=_.NB_VALD.strip().re_replace("Moins de 5", "4").cast(int)
@@ -52,70 +109,220 @@ def load_surface(con):
     return surface
 
 
-def ibis_regular_time_grid(surface):
-    all_days = surface.alias("s").sql(
-        """
-    SELECT CAST(d AS DATE) AS DAY FROM
-    generate_series(
-        (SELECT min(DAY) FROM s), (SELECT max(DAY) FROM s) + INTERVAL '10 days', INTERVAL '1 day') AS t(d)
-    """
+def load_surface_features(
+    con,
+    *,
+    lagged=True,
+    school_holidays=True,
+    holidays=True,
+    lags=LAGS,
+    avg_widths=AVG_WIDTHS,
+):
+    # a polars LazyFrame, see features.py
+    with tracing.duckdb_profile(con, "load_surface") as trace:
+        counts = load_surface(con).to_polars()
+        trace["rows_out"] = counts.height
+    return features.build_features(
+        counts,
+        lagged=lagged,
+        school_holidays=load_table(con, "school_holidays") if school_holidays else None,
+        holidays=load_table(con, "holidays") if holidays else None,
+        lags=lags,
+        avg_widths=avg_widths,
     )
-    all_points = all_days.cross_join(surface.select("LINE").distinct())
-    surface = (
-        all_points.left_join(
-            surface, (surface.LINE == all_points.LINE, surface.DAY == all_points.DAY)
+
+
+def load_table(con, table_name):
+    return con.table(table_name).to_polars().lazy()
+
+
+def _hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+
+@tracing.traced
+def data_fingerprint(con):
+    # changes whenever a source file is (re)loaded or the holidays change
+    tables = con.list_tables()
+    if "ingested_files" in tables:
+        sources = (
+            con.table("ingested_files")
+            .filter(_.status == "loaded")
+            .select("path", "sha256")
+            .order_by("path")
         )
-        .drop(["DAY_right", "LINE_right"])
-        .order_by("DAY", "LINE")
+        content = sources.to_polars().write_csv()
+    else:
+        summary = load_surface(con).aggregate(
+            n=_.count(), total=_.N.sum(), last_day=_.DAY.max()
+        )
+        content = str(summary.to_polars().row(0))
+    # the holiday tables are small: their whole content is hashed
+    for table_name in ["school_holidays", "holidays"]:
+        table = con.table(table_name)
+        rows = table.order_by(*table.columns).to_polars().write_csv()
+        content += f"\n{table_name}:\n{rows}"
+    return _hash(content)
+
+
+def _evict_features(cache_dir, config_key, keep):
+    # entries computed with the same options on older data are stale; beyond
+    # that only the most recently used tables are kept
+    entries = sorted(
+        cache_dir.glob("features-*.arrow"),
+        key=lambda p: p.stat().st_mtime,
+        reverse=True,
     )
-    return surface
+    for i, entry in enumerate(entries):
+        stale = entry.name.startswith(f"features-{config_key}-") and entry != keep
+        if stale or i >= MAX_CACHED_FEATURE_TABLES:
+            entry.unlink(missing_ok=True)
 
 
-def polars_regular_time_grid(df):
-    dates = pl.DataFrame(
-        {"DAY": pl.date_range(df["DAY"].min(), df["DAY"].max(), "1d", eager=True)}
+def load_cached_surface_features(
+    con,
+    *,
+    lagged=True,
+    school_holidays=True,
+    holidays=True,
+    lags=LAGS,
+    avg_widths=AVG_WIDTHS,
+    cache_dir=FEATURE_CACHE_DIR,
+):
+    # load_surface_features() as a polars dataframe, stored in an arrow file
+    # keyed by the source data and the feature options and memory-mapped on
+    # later calls
+    options = {
+        "lagged": lagged,
+        "school_holidays": school_holidays,
+        "holidays": holidays,
+        "lags": list(lags),
+        "avg_widths": list(avg_widths),
+        "avg_lag": AVG_LAG,
+        "grid_extension_days": GRID_EXTENSION_DAYS,
+        "schema_version": FEATURE_SCHEMA_VERSION,
+    }
+    config_key = _hash(json.dumps(options, sort_keys=True))
+    path = cache_dir / f"features-{config_key}-{data_fingerprint(con)}.arrow"
+    if path.is_file():
+        path.touch()
+        return pl.read_ipc(path, memory_map=True)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    surface_features = load_surface_features(
+        con,
+        lagged=lagged,
+        school_holidays=school_holidays,
+        holidays=holidays,
+        lags=lags,
+        avg_widths=avg_widths,
     )
-    points = dates.join(df.select("LINE").unique(), how="cross")
-    df = points.join(df, on=["DAY", "LINE"], how="left")
-    return df
+    with tracing.stage("load_surface_features") as trace:
+        surface_features = surface_features.collect(engine="streaming")
+        trace["rows_out"] = surface_features.height
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    surface_features.write_ipc(tmp_path, compression="uncompressed")
+    tmp_path.replace(path)
+    _evict_features(cache_dir, config_key, path)
+    return pl.read_ipc(path, memory_map=True)
 
 
-def add_lagged_features(surface):
-    lags = {f"N_lag_{lag}": _.N.lag(lag) for lag in [3, 4, 5, 6, 7, 14, 21, 28, 35]}
-    surface = surface.group_by("LINE").order_by("DAY").mutate(**lags)
-    averages = {}
-    avg_lag = 3
-    for width in [3, 7, 30, 90]:
-        w = ibis.window(
-            group_by="LINE",
-            order_by="DAY",
-            preceding=width + avg_lag,
-            following=-avg_lag,
+def read_surface_features(database=DATABASE, **options):
+    # Takes a path rather than a connection so that it can be part of a skrub
+    # pipeline sent to joblib workers: each process opens its own read-only
+    # connection and memory-maps the cached feature table.
+    return load_cached_surface_features(connect(database), **options)
+
+
+def load_surface_features_at(con, keys):
+    # Same rows and values as load_surface_features() joined with `keys` (a
+    # polars dataframe with DAY and LINE), but only reads the history needed by
+    # the lags and rolling means of the requested points. Returns a polars
+    # dataframe.
+    max_offset = max(max(LAGS), max(AVG_WIDTHS) + AVG_LAG)
+    surface = load_surface(con)
+    keys = keys.select(pl.col("DAY").cast(pl.Date), "LINE").unique()
+    lines = keys["LINE"].unique().to_list()
+    history = surface.filter(
+        _.LINE.isin(lines),
+        _.DAY >= keys["DAY"].min() - timedelta(days=max_offset),
+        _.DAY <= keys["DAY"].max(),
+    )
+    # points outside of their line's time grid have no features
+    spans = (
+        surface.filter(_.LINE.isin(lines))
+        .group_by("LINE")
+        .aggregate(first_day=_.DAY.min(), last_day=_.DAY.max())
+    )
+    points = (
+        ibis.memtable(keys)
+        .join(spans, "LINE")
+        .filter(
+            _.DAY >= _.first_day,
+            _.DAY <= _.last_day + ibis.interval(days=GRID_EXTENSION_DAYS),
         )
-        averages[f"N_lag_{avg_lag}_avg_{width}"] = _.N.mean().over(w)
-    surface = surface.mutate(**averages)
-    return surface.order_by("DAY", "LINE")
+        .drop("first_day", "last_day")
+    )
 
+    past = history.select(H_DAY=_.DAY, H_LINE=_.LINE, H_N=_.N)
+    pairs = points.join(
+        past,
+        [
+            past.H_LINE == points.LINE,
+            past.H_DAY >= points.DAY - ibis.interval(days=max_offset),
+            past.H_DAY <= points.DAY - ibis.interval(days=MIN_LAG),
+        ],
+    )
+    lags = {
+        f"N_lag_{lag}": _.H_N.max(where=_.H_DAY == _.DAY - ibis.interval(days=lag))
+        for lag in LAGS
+    }
+    averages = {
+        f"N_lag_{AVG_LAG}_avg_{width}": _.H_N.mean(
+            where=(_.H_DAY >= _.DAY - ibis.interval(days=width + AVG_LAG))
+            & (_.H_DAY <= _.DAY - ibis.interval(days=AVG_LAG))
+        )
+        for width in AVG_WIDTHS
+    }
+    lagged = (
+        pairs.group_by("DAY", "LINE")
+        .aggregate(**lags, **averages)
+        .rename(L_DAY="DAY", L_LINE="LINE")
+    )
+    observed = history.rename(H_DAY="DAY", H_LINE="LINE")
 
-def add_datetime_features(surface):
-    return surface.mutate(
-        day_of_month=_.DAY.day(),
-        day_of_year=_.DAY.day_of_year(),
-        month=_.DAY.month(),
-        year=_.DAY.year(),
-        week=_.DAY.week_of_year(),
-        weekday=_.DAY.day_of_week.index(),
+    point_features = (
+        points.left_join(
+            observed, [observed.H_DAY == points.DAY, observed.H_LINE == points.LINE]
+        )
+        .left_join(lagged, [lagged.L_DAY == points.DAY, lagged.L_LINE == points.LINE])
+        .drop("H_DAY", "H_LINE", "L_DAY", "L_LINE")
+        .to_polars()
+        .lazy()
+    )
+    point_features = features.add_datetime_features(point_features)
+    point_features = features.add_school_holidays(
+        point_features, load_table(con, "school_holidays")
     )
+    point_features = features.add_holidays(point_features, load_table(con, "holidays"))
+    return point_features.drop("N").sort("DAY", "LINE").collect()
 
 
-def load_surface_features(con):
-    surface = load_surface(con)
-    surface = ibis_regular_time_grid(surface)
-    surface = add_lagged_features(surface)
-    surface = add_datetime_features(surface)
-    surface = add_school_holidays(surface, con)
-    surface = add_holidays(surface, con)
-    return surface.drop("N")
+def add_horizons(con, keys):
+    # Days between each point and the last observation of its line. Features
+    # are complete up to MIN_LAG days, some lags are missing up to
+    # GRID_EXTENSION_DAYS, and points further away have no features at all.
+    last_days = (
+        load_surface(con)
+        .filter(_.LINE.isin(keys["LINE"].unique().to_list()))
+        .group_by("LINE")
+        .aggregate(last_day=_.DAY.max())
+        .to_polars()
+    )
+    return (
+        keys.join(last_days, on="LINE", how="left")
+        .with_columns(horizon=(pl.col("DAY") - pl.col("last_day")).dt.total_days())
+        .drop("last_day")
+    )
 
 
 def load_data_points(con):
@@ -3,108 +3,516 @@ https://eu.ftp.opendatasoft.com/stif/Validations/Donnees_de_validation.pdf
 https://prim.iledefrance-mobilites.fr/en/jeux-de-donnees/histo-validations-reseau-ferre
 
 """
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import hashlib
 import itertools
+import json
+import os
 import pathlib
 import shutil
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
 import duckdb
 
+import data_access
+import tracing
+
 OUT_DIR = pathlib.Path(__file__).parent / "data"
 OUT_DIR.mkdir(exist_ok=True)
 
-API_ROOT = "https://data.iledefrance-mobilites.fr/api/explore/v2.1"
+API_ROOT = os.environ.get(
+    "RATP_API_ROOT", "https://data.iledefrance-mobilites.fr/api/explore/v2.1"
+)
 RAIL_METADATA_URL = "catalog/datasets/histo-validations-reseau-ferre/exports/json"
 SURFACE_METADATA_URL = "catalog/datasets/histo-validations-reseau-surface/exports/json"
+CSV_BUFFER_SIZE = 32 * 2**20
+DOWNLOAD_CHUNK_SIZE = 2**20
+N_DOWNLOAD_JOBS = 4
+MANIFEST = OUT_DIR / "manifest.json"
+STAGING_DIR = OUT_DIR / "staging"
+TABLES = {"rf": "rail", "rs": "surface"}
 
 
-def _download(url, key):
-    print(f"Download {key!r}")
-    validation_metadata = requests.get(f"{API_ROOT}/{url}").json()
+def _session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-    for year_metadata in validation_metadata:
-        print(year_metadata["annee"])
-        year_dir = OUT_DIR / year_metadata["annee"]
-        year_dir.mkdir(exist_ok=True)
-        year_data = requests.get(year_metadata[key]["url"])
-        (year_dir / f"{key}.zip").write_bytes(year_data.content)
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
-def download_data():
-    _download(RAIL_METADATA_URL, "reseau_ferre")
-    _download(SURFACE_METADATA_URL, "reseau_de_surface")
+class _Manifest:
+    # url -> etag, last-modified and checksum of the archive we have on disk,
+    # so that unchanged archives are not downloaded again
+    def __init__(self, path):
+        self.path = path
+        self.entries = json.loads(path.read_text()) if path.is_file() else {}
+        self.lock = threading.Lock()
 
+    def get(self, url):
+        with self.lock:
+            return dict(self.entries.get(url, {}))
 
-def extract():
-    print("Extract")
-    for year_data in OUT_DIR.glob("*/*.zip"):
-        print(year_data)
-        shutil.unpack_archive(year_data, year_data.parent)
+    def update(self, url, **values):
+        with self.lock:
+            self.entries.setdefault(url, {}).update(values)
+            tmp = self.path.with_name(f"{self.path.name}.tmp")
+            tmp.write_text(json.dumps(self.entries, indent=2))
+            tmp.replace(self.path)
+
+
+def _fetch(session, manifest, url, out_file):
+    entry = manifest.get(url)
+    part = out_file.with_name(f"{out_file.name}.part")
+    headers = {}
+    if out_file.is_file() and entry.get("sha256") == _sha256(out_file):
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    elif part.is_file() and entry.get("partial_etag"):
+        headers["Range"] = f"bytes={part.stat().st_size}-"
+        headers["If-Range"] = entry["partial_etag"]
+    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 304:
+            print(f"{out_file}: unchanged")
+            return
+        response.raise_for_status()
+        resumed = response.status_code == 206
+        manifest.update(url, partial_etag=response.headers.get("ETag"))
+        with open(part, "ab" if resumed else "wb") as stream:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                stream.write(chunk)
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+    part.replace(out_file)
+    manifest.update(
+        url,
+        etag=etag,
+        last_modified=last_modified,
+        sha256=_sha256(out_file),
+        partial_etag=None,
+    )
+    print(f"{out_file}: {'resumed' if resumed else 'downloaded'}")
+
+
+def _list_archives(session, url, key):
+    validation_metadata = session.get(f"{API_ROOT}/{url}", timeout=60)
+    validation_metadata.raise_for_status()
+    for year_metadata in validation_metadata.json():
+        year_dir = OUT_DIR / year_metadata["annee"]
+        year_dir.mkdir(exist_ok=True)
+        yield year_metadata[key]["url"], year_dir / f"{key}.zip"
+
+
+@tracing.traced
+def download_data(n_jobs=N_DOWNLOAD_JOBS):
+    print("Download")
+    session = _session(n_jobs)
+    manifest = _Manifest(MANIFEST)
+    archives = [
+        *_list_archives(session, RAIL_METADATA_URL, "reseau_ferre"),
+        *_list_archives(session, SURFACE_METADATA_URL, "reseau_de_surface"),
+    ]
+    with ThreadPoolExecutor(n_jobs) as pool:
+        futures = [
+            pool.submit(_fetch, session, manifest, url, out_file)
+            for url, out_file in archives
+        ]
+        for future in futures:
+            future.result()
 
 
 def get_connection():
     return duckdb.connect(OUT_DIR / "ratp.duckdb")
 
 
-def _to_utf8(path):
-    out = path.with_name(f"{path.name}.utf8")
-    with open(path, "rb") as in_stream:
-        with open(out, "wb") as out_stream:
-            while chunk := in_stream.read(1024):
-                out_stream.write(chunk.decode("latin-1").encode("utf-8"))
-    return out
+def _sniff_delimiter(path):
+    with open(path, "rb") as f:
+        line = f.readline()
+    return ";" if b";" in line else "\t"
 
 
-def _load(table_name, key):
-    print("Create db")
+def _read_csv(path, delim, types):
+    # duckdb decodes latin-1 itself so we do not need a transcoded copy
+    return (
+        f"read_csv('{path}', delim='{delim}', types={types}, nullstr=['?', ''], "
+        f"encoding='latin-1', buffer_size={CSV_BUFFER_SIZE})"
+    )
+
+
+def _table_exists(con, table_name):
+    (n,) = con.execute(
+        "SELECT count(*) FROM information_schema.tables WHERE table_name = ?",
+        [table_name],
+    ).fetchone()
+    return n > 0
+
+
+def _create_ledger(con):
+    # one row per source file: lets us load only new or modified files
+    con.sql(
+        """
+    CREATE TABLE IF NOT EXISTS ingested_files (
+        path VARCHAR PRIMARY KEY,
+        table_name VARCHAR,
+        sha256 VARCHAR,
+        n_rows BIGINT,
+        status VARCHAR,
+        error VARCHAR,
+        loaded_at TIMESTAMP
+    )
+    """
+    )
+
+
+def _ledger_hashes(con):
+    return dict(
+        con.execute(
+            "SELECT path, sha256 FROM ingested_files WHERE status = 'loaded'"
+        ).fetchall()
+    )
+
+
+def _record(con, path, table_name, sha256, n_rows, status, error=None):
+    con.execute(
+        "INSERT OR REPLACE INTO ingested_files VALUES (?, ?, ?, ?, ?, ?, now())",
+        [path, table_name, sha256, n_rows, status, error],
+    )
+
+
+def _source_files(year_dir, key):
     long_key = {"rs": "SURFACE", "rf": "FER"}[key]
-    con = get_connection()
-    for i, year_csv in enumerate(
-        filter(
-            lambda p: p.suffix != ".utf8",
-            itertools.chain(
-                OUT_DIR.glob(f"*/data-{key}*/*NB*"),
-                OUT_DIR.glob(f"*/*NB_{long_key}.txt"),
-            ),
+    return filter(
+        lambda p: p.suffix != ".utf8",
+        itertools.chain(
+            year_dir.glob(f"data-{key}*/*NB*"),
+            year_dir.glob(f"*NB_{long_key}.txt"),
+        ),
+    )
+
+
+def _column_types(key):
+    types = {
+        "NB_VALD": "VARCHAR",
+        "CODE_STIF_RES": "VARCHAR",
+        "CODE_STIF_LIGNE": "VARCHAR",
+        "CODE_STIF_ARRET": "VARCHAR",
+    }
+    if key == "rf":
+        types.pop("CODE_STIF_LIGNE")
+    else:
+        types.pop("CODE_STIF_ARRET")
+    return types
+
+
+def _unpack(year_dir):
+    for archive in year_dir.glob("*.zip"):
+        stamp = archive.with_name(f"{archive.name}.extracted")
+        if stamp.is_file() and stamp.stat().st_mtime >= archive.stat().st_mtime:
+            continue
+        shutil.unpack_archive(archive, year_dir)
+        stamp.touch()
+
+
+def _parse(year_csv, key):
+    staged = STAGING_DIR / year_csv.relative_to(OUT_DIR).with_suffix(".parquet")
+    staged.parent.mkdir(parents=True, exist_ok=True)
+    source = _read_csv(year_csv, _sniff_delimiter(year_csv), _column_types(key))
+    with duckdb.connect() as con:
+        con.sql(f"COPY (SELECT * FROM {source}) TO '{staged}' (FORMAT parquet)")
+    return staged
+
+
+def _prepare_year(year_dir, loaded):
+    # worker: unpack the year's archives then parse each new or modified
+    # source file to a staged parquet file
+    timings = defaultdict(float)
+    start = time.perf_counter()
+    with tracing.stage("download.unpack", year=year_dir.name):
+        _unpack(year_dir)
+    timings["unpack"] += time.perf_counter() - start
+    files = []
+    for key, table_name in TABLES.items():
+        for year_csv in _source_files(year_dir, key):
+            source_file = str(year_csv.relative_to(OUT_DIR))
+            start = time.perf_counter()
+            sha256 = _sha256(year_csv)
+            timings["hash"] += time.perf_counter() - start
+            if loaded.get(source_file) == sha256:
+                continue
+            info = {"source_file": source_file, "table_name": table_name}
+            info["sha256"] = sha256
+            size = year_csv.stat().st_size / 2**20
+            start = time.perf_counter()
+            with tracing.stage("download.parse", file=source_file, size_mib=size):
+                try:
+                    info["staged"] = _parse(year_csv, key)
+                except duckdb.Error as e:
+                    info["error"] = str(e)
+            duration = time.perf_counter() - start
+            timings["parse"] += duration
+            print(
+                f"{year_csv}: parsed {size:.1f} MiB in {duration:.1f}s "
+                f"({size / duration:.1f} MiB/s)"
+            )
+            files.append(info)
+    return files, timings
+
+
+# Same cleaning as data_access.load_surface, materialized once at ingest time
+_DAILY_LINE_COUNTS = """
+SELECT
+    JOUR AS DAY,
+    concat_ws(
+        '__',
+        CAST(CODE_STIF_TRNS AS VARCHAR),
+        CAST(CODE_STIF_RES AS VARCHAR),
+        CAST(CODE_STIF_LIGNE AS VARCHAR)
+    ) AS LINE,
+    CODE_STIF_TRNS,
+    CODE_STIF_RES,
+    CODE_STIF_LIGNE,
+    sum(N) AS N,
+    first(LIBELLE_LIGNE) FILTER (WHERE LIBELLE_LIGNE IS NOT NULL) AS LINE_NAME
+FROM (
+    SELECT
+        JOUR,
+        CAST(regexp_replace(trim(NB_VALD), 'Moins de 5', '4', 'g') AS BIGINT) AS N,
+        CASE
+            WHEN LIBELLE_LIGNE IN ('?', 'NON DEFINI', 'LIGNE NON DEFINIE', '')
+            THEN NULL ELSE LIBELLE_LIGNE
+        END AS LIBELLE_LIGNE,
+        TRY_CAST(trim(CAST(CODE_STIF_TRNS AS VARCHAR)) AS INTEGER) AS CODE_STIF_TRNS,
+        TRY_CAST(trim(CAST(CODE_STIF_RES AS VARCHAR)) AS INTEGER) AS CODE_STIF_RES,
+        TRY_CAST(trim(CAST(CODE_STIF_LIGNE AS VARCHAR)) AS INTEGER) AS CODE_STIF_LIGNE
+    FROM surface
+    WHERE {where}
+)
+WHERE
+    CODE_STIF_TRNS IS NOT NULL
+    AND CODE_STIF_RES IS NOT NULL
+    AND CODE_STIF_LIGNE IS NOT NULL
+GROUP BY JOUR, CODE_STIF_TRNS, CODE_STIF_RES, CODE_STIF_LIGNE
+"""
+
+
+def _create_daily_line_counts(con):
+    # LINE strings are stored once in `lines`, the counts refer to them by id
+    con.sql(
+        """
+    CREATE TABLE IF NOT EXISTS lines (
+        LINE_ID INTEGER PRIMARY KEY,
+        LINE VARCHAR UNIQUE,
+        CODE_STIF_TRNS INTEGER,
+        CODE_STIF_RES INTEGER,
+        CODE_STIF_LIGNE INTEGER
+    )
+    """
+    )
+    con.sql(
+        """
+    CREATE TABLE IF NOT EXISTS daily_line_counts (
+        DAY DATE,
+        LINE_ID INTEGER,
+        N BIGINT,
+        LINE_NAME VARCHAR
+    )
+    """
+    )
+
+
+@tracing.traced
+def _refresh_daily_line_counts(con, changed_days_only=True):
+    # recompute the aggregates of the days listed in the changed_days temp
+    # table, or of all days
+    days = "(SELECT DAY FROM changed_days)"
+    source_filter = f"JOUR IN {days}" if changed_days_only else "true"
+    days_filter = f"DAY IN {days}" if changed_days_only else "true"
+    con.sql(
+        "CREATE OR REPLACE TEMP TABLE new_counts AS "
+        + _DAILY_LINE_COUNTS.format(where=source_filter)
+    )
+    con.sql(
+        """
+    INSERT INTO lines
+    SELECT
+        coalesce((SELECT max(LINE_ID) FROM lines), 0)
+            + row_number() OVER (ORDER BY LINE),
+        LINE, CODE_STIF_TRNS, CODE_STIF_RES, CODE_STIF_LIGNE
+    FROM (
+        SELECT DISTINCT LINE, CODE_STIF_TRNS, CODE_STIF_RES, CODE_STIF_LIGNE
+        FROM new_counts
+    )
+    WHERE LINE NOT IN (SELECT LINE FROM lines)
+    """
+    )
+    con.sql(f"DELETE FROM daily_line_counts WHERE {days_filter}")
+    con.sql(
+        """
+    INSERT INTO daily_line_counts
+    SELECT DAY, LINE_ID, N, LINE_NAME FROM new_counts JOIN lines USING (LINE)
+    ORDER BY DAY, LINE_ID
+    """
+    )
+    con.sql("DROP TABLE new_counts")
+
+
+def _drop_legacy_rows(con, table_name):
+    # Tables loaded before the ledger existed have no SOURCE_FILE, so their
+    # rows would never be replaced and every file would be counted twice. None
+    # of their files are in the ledger, so they are all loaded again by this
+    # run: the legacy rows are deleted (in the caller's transaction) and the
+    # aggregates of their days recomputed from what is left.
+    (n_legacy,) = con.execute(
+        f"SELECT count(*) FROM {table_name} WHERE SOURCE_FILE IS NULL"
+    ).fetchone()
+    if not n_legacy:
+        return
+    print(f"{table_name}: dropping {n_legacy:,} rows loaded without a source file")
+    if table_name == "surface":
+        con.sql(
+            "INSERT INTO changed_days "
+            "SELECT DISTINCT JOUR FROM surface WHERE SOURCE_FILE IS NULL"
         )
-    ):
-        print(i, year_csv)
-        utf8 = _to_utf8(year_csv)
-        with open(utf8, "r") as f:
-            line = f.readline()
-            delim = ";" if ";" in line else "\t"
-        types = {
-            "NB_VALD": "VARCHAR",
-            "CODE_STIF_RES": "VARCHAR",
-            "CODE_STIF_LIGNE": "VARCHAR",
-            "CODE_STIF_ARRET": "VARCHAR",
-        }
-        if key == "rf":
-            types.pop("CODE_STIF_LIGNE")
-        else:
-            types.pop("CODE_STIF_ARRET")
-        try:
-            try:
-                con.sql(
-                    f"insert into {table_name} SELECT * from "
-                    f"read_csv('{utf8}', delim='{delim}', types={types}, nullstr=['?', '']);"
-                )
-            except duckdb.CatalogException:
-                con.sql(
-                    f"CREATE TABLE {table_name} as SELECT * from "
-                    f"read_csv('{utf8}', delim='{delim}', types={types}, nullstr=['?', '']);"
+    con.sql(f"DELETE FROM {table_name} WHERE SOURCE_FILE IS NULL")
+
+
+def _load_file(con, table_name, source_file, staged, sha256):
+    # rows are tagged with their source file so that a modified file replaces
+    # its previous version in a single transaction
+    select = f"SELECT *, '{source_file}' AS SOURCE_FILE FROM read_parquet('{staged}')"
+    is_surface = table_name == "surface"
+    con.begin()
+    try:
+        if is_surface:
+            con.sql("CREATE OR REPLACE TEMP TABLE changed_days (DAY DATE)")
+        if _table_exists(con, table_name):
+            con.sql(
+                f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS SOURCE_FILE VARCHAR"
+            )
+            _drop_legacy_rows(con, table_name)
+            if is_surface:
+                con.execute(
+                    "INSERT INTO changed_days "
+                    "SELECT DISTINCT JOUR FROM surface WHERE SOURCE_FILE = ?",
+                    [source_file],
                 )
-        except duckdb.InvalidInputException:
-            print(f"FAILED: {year_csv}")
-            continue
+            con.execute(
+                f"DELETE FROM {table_name} WHERE SOURCE_FILE = ?", [source_file]
+            )
+            con.sql(f"INSERT INTO {table_name} {select}")
+        else:
+            con.sql(f"CREATE TABLE {table_name} AS {select}")
+        if is_surface:
+            con.execute(
+                "INSERT INTO changed_days "
+                "SELECT DISTINCT JOUR FROM surface WHERE SOURCE_FILE = ?",
+                [source_file],
+            )
+            _refresh_daily_line_counts(con)
+        (n_rows,) = con.execute(
+            f"SELECT count(*) FROM {table_name} WHERE SOURCE_FILE = ?", [source_file]
+        ).fetchone()
+        _record(con, source_file, table_name, sha256, n_rows, "loaded")
+        con.commit()
+    except duckdb.Error as e:
+        con.rollback()
+        _record(con, source_file, table_name, sha256, None, "failed", str(e))
+        print(f"FAILED: {source_file}: {e}")
+        return None
+    return n_rows
+
 
+def _print_timings(timings, wall_time):
+    print("Timings (seconds, summed over workers):")
+    for stage, duration in timings.items():
+        print(f"  {stage:<10}{duration:>10.1f}")
+    print(f"  {'wall':<10}{wall_time:>10.1f}")
 
-def load():
-    _load("rail", "rf")
-    _load("surface", "rs")
+
+@tracing.traced
+def load(n_jobs=None):
+    print("Create db")
+    wall_start = time.perf_counter()
+    con = get_connection()
+    _create_ledger(con)
+    if not _table_exists(con, "daily_line_counts"):
+        _create_daily_line_counts(con)
+        if _table_exists(con, "surface"):
+            _refresh_daily_line_counts(con, changed_days_only=False)
+    loaded = _ledger_hashes(con)
+    year_dirs = sorted(p for p in OUT_DIR.iterdir() if p.is_dir() and p != STAGING_DIR)
+    timings = defaultdict(float)
+    # workers unpack and parse, this process is the only writer
+    with ProcessPoolExecutor(n_jobs) as pool:
+        futures = [pool.submit(_prepare_year, year, loaded) for year in year_dirs]
+        for future in as_completed(futures):
+            files, year_timings = future.result()
+            for stage, duration in year_timings.items():
+                timings[stage] += duration
+            for info in files:
+                if "error" in info:
+                    _record(
+                        con,
+                        info["source_file"],
+                        info["table_name"],
+                        info["sha256"],
+                        None,
+                        "failed",
+                        info["error"],
+                    )
+                    print(f"FAILED: {info['source_file']}: {info['error']}")
+                    continue
+                start = time.perf_counter()
+                insert = tracing.stage("download.insert", file=info["source_file"])
+                with insert as trace:
+                    n_rows = _load_file(
+                        con,
+                        info["table_name"],
+                        info["source_file"],
+                        info["staged"],
+                        info["sha256"],
+                    )
+                    trace["rows_out"] = n_rows
+                timings["insert"] += time.perf_counter() - start
+                info["staged"].unlink()
+                if n_rows is not None:
+                    print(f"{info['source_file']}: inserted {n_rows:,} rows")
+    con.close()
+    _print_timings(timings, time.perf_counter() - wall_start)
 
 
 if __name__ == "__main__":
-    download_data()
-    extract()
-    load()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_jobs", type=int, default=None)
+    parser.add_argument("--skip_download", action="store_true")
+    parser.add_argument("--trace", default=None, help="write a Chrome trace here")
+    # also write the daily counts as a parquet dataset partitioned by year and
+    # line, readable with RATP_DATABASE=data/dataset
+    parser.add_argument("--export_dataset", action="store_true")
+    args = parser.parse_args()
+    if args.trace is not None:
+        tracing.start(args.trace)
+    if not args.skip_download:
+        start = time.perf_counter()
+        download_data()
+        print(f"Download: {time.perf_counter() - start:.1f}s")
+    load(args.n_jobs)
+    if args.export_dataset:
+        data_access.export_dataset(data_access.connect(OUT_DIR / "ratp.duckdb"))
@@ -1,52 +1,106 @@
-from datetime import date, timedelta
-
-import ibis
-from ibis import _
+import numpy as np
 import polars as pl
 
+import tracing
+
+
+def _sorted_days(data, time_col):
+    days = data[time_col].to_numpy()
+    if np.all(days[1:] >= days[:-1]):
+        return days, None
+    order = np.argsort(days, kind="stable")
+    return days[order], order
 
-def cv_split(data, gap=3, test_length=90, min_train_size=90):
-    split_dates = pl.date_range(
-        data["DAY"].min() + timedelta(days=min_train_size),
-        data["DAY"].max() - timedelta(days=gap),
-        interval=timedelta(days=test_length),
-        closed="left",
-        eager=True,
+
+def _split_bounds(days, gap, test_length, min_train_size):
+    # (train stop, test start, test stop) row positions in the sorted days
+    split_dates = np.arange(
+        days[0] + np.timedelta64(min_train_size, "D"),
+        days[-1] - np.timedelta64(gap, "D"),
+        np.timedelta64(test_length, "D"),
     )
-    for split_d in split_dates:
-        train = (
-            data.with_row_index().filter(pl.col("DAY") < split_d)["index"].to_numpy()
-        )
-        test = (
-            data.with_row_index()
-            .filter(
-                (pl.col("DAY") >= split_d + timedelta(days=gap))
-                & (pl.col("DAY") < split_d + timedelta(days=test_length + gap))
-            )["index"]
-            .to_numpy()
-        )
-        if len(train) and len(test):
-            yield train, test
+    train_stop = np.searchsorted(days, split_dates)
+    test_start = np.searchsorted(days, split_dates + np.timedelta64(gap, "D"))
+    test_stop = np.searchsorted(
+        days, split_dates + np.timedelta64(test_length + gap, "D")
+    )
+    bounds = np.stack([train_stop, test_start, test_stop], axis=1)
+    return bounds[(train_stop > 0) & (test_stop > test_start)]
+
+
+def _indices(bounds, order):
+    train_stop, test_start, test_stop = bounds
+    if order is None:
+        return np.arange(train_stop), np.arange(test_start, test_stop)
+    return np.sort(order[:train_stop]), np.sort(order[test_start:test_stop])
+
+
+def cv_split(data, gap=3, test_length=90, min_train_size=90, time_col="DAY"):
+    # DAY is sorted once and the split dates are turned into row positions with
+    # searchsorted, instead of filtering the whole frame for every split
+    days, order = _sorted_days(data, time_col)
+    for bounds in _split_bounds(days, gap, test_length, min_train_size):
+        yield _indices(bounds, order)
 
 
 class Splitter:
-    def __init__(self, max_splits=None, gap=3, test_length=90, min_train_size=90):
+    def __init__(
+        self, max_splits=None, gap=3, test_length=90, min_train_size=90, time_col="DAY"
+    ):
         self.max_splits = max_splits
         self.gap = gap
         self.test_length = test_length
         self.min_train_size = min_train_size
+        self.time_col = time_col
+        self._cache = None
+
+    def __getstate__(self):
+        return {**self.__dict__, "_cache": None}
+
+    def _bounds(self, X):
+        # cached for the last input: get_n_splits and split are usually called
+        # on the same frame
+        if self._cache is not None and self._cache[0] is X:
+            return self._cache[1:]
+        with tracing.stage("evaluation.split", rows_in=len(X)) as trace:
+            days, order = _sorted_days(X, self.time_col)
+            bounds = _split_bounds(
+                days, self.gap, self.test_length, self.min_train_size
+            )
+            if self.max_splits is not None:
+                bounds = bounds[max(0, len(bounds) - self.max_splits) :]
+            trace["n_splits"] = len(bounds)
+        self._cache = X, bounds, order
+        return bounds, order
 
     def split(self, X, y=None, groups=None):
-        splits = cv_split(
-            X,
-            gap=self.gap,
-            test_length=self.test_length,
-            min_train_size=self.min_train_size,
-        )
-        splits = list(splits)
-        if self.max_splits is None:
-            return splits
-        return splits[max(0, len(splits) - self.max_splits):]
+        bounds, order = self._bounds(X)
+        return [_indices(b, order) for b in bounds]
+
+    def split_slices(self, X):
+        # for frames sorted by time every fold is contiguous: slices avoid
+        # gathering rows
+        bounds, order = self._bounds(X)
+        if order is not None:
+            raise ValueError(f"split_slices needs data sorted by {self.time_col}")
+        return [(slice(0, a), slice(b, c)) for a, b, c in bounds]
 
     def get_n_splits(self, X, y=None, groups=None):
-        return len(self.split(X))
+        return len(self._bounds(X)[0])
+
+
+@tracing.traced
+def errors_per_line(results):
+    # results: out-of-sample predictions with LINE, N and predicted columns
+    abs_error = (pl.col("N") - pl.col("predicted")).abs()
+    return (
+        results.group_by("LINE")
+        .agg(
+            LINE_NAME=pl.col("LINE_NAME").drop_nulls().first(),
+            n_days=pl.len(),
+            mean_N=pl.col("N").mean(),
+            MAE=abs_error.mean(),
+            MAPE=(abs_error / pl.col("N")).filter(pl.col("N") > 0).mean(),
+        )
+        .sort("n_days", "mean_N", descending=True)
+    )
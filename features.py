@@ -0,0 +1,135 @@
+"""Lag, rolling mean, calendar and holiday features on polars LazyFrames.
+
+Used by data_access for all the surface lines, by rail.py for the stops and
+by subset/utils.py for a single line. The input has one row per series (`key`)
+and day (`time_col`) with an N column; every series is extended to a regular
+daily grid so that a lag of k days is a shift of k rows within the series.
+
+For a day t of a series:
+
+- N_lag_k is N on day t - k, null if that day has no count;
+- N_lag_{AVG_LAG}_avg_w is the mean of the non-null counts of the w + 1 days
+  from t - AVG_LAG - w to t - AVG_LAG included, null if they are all missing;
+- is_school_holiday is 1 from the start_date of a Paris school holiday up to
+  the day before its end_date, 0 otherwise;
+- is_holiday is true on public holidays.
+
+Everything stays lazy, so the result can be collected with the streaming
+engine.
+"""
+import polars as pl
+
+LAGS = [3, 4, 5, 6, 7, 14, 21, 28, 35]
+AVG_LAG = 3
+AVG_WIDTHS = [3, 7, 30, 90]
+# all the lagged features of a day are known up to MIN_LAG days after the last
+# observation
+MIN_LAG = min(min(LAGS), AVG_LAG)
+GRID_EXTENSION_DAYS = 10
+# bump when the meaning of the feature columns changes: exported models refuse
+# to load against another version, cached feature tables and scores are
+# recomputed
+FEATURE_SCHEMA_VERSION = 2
+
+
+def line_time_grid(
+    counts, max_offset=GRID_EXTENSION_DAYS, *, key="LINE", time_col="DAY"
+):
+    # Each series spans from its first observed day to max_offset days after
+    # its last one, instead of crossing every day with every series.
+    counts = counts.lazy()
+    points = (
+        counts.group_by(key)
+        .agg(first_day=pl.col(time_col).min(), last_day=pl.col(time_col).max())
+        .select(
+            key,
+            pl.date_ranges(
+                "first_day", pl.col("last_day") + pl.duration(days=max_offset), "1d"
+            ).alias(time_col),
+        )
+        .explode(time_col)
+        .select(time_col, key)
+    )
+    return points.join(counts, on=[time_col, key], how="left")
+
+
+def add_lagged_features(
+    frame, lags=LAGS, avg_widths=AVG_WIDTHS, *, key="LINE", time_col="DAY"
+):
+    # frame must be on the regular grid of line_time_grid()
+    n = pl.col("N")
+    lagged = {f"N_lag_{lag}": n.shift(lag).over(key) for lag in lags}
+    averages = {
+        f"N_lag_{AVG_LAG}_avg_{width}": n.shift(AVG_LAG)
+        .rolling_mean(width + 1, min_samples=1)
+        .over(key)
+        for width in avg_widths
+    }
+    return frame.sort(key, time_col).with_columns(**lagged, **averages)
+
+
+def add_datetime_features(frame, *, time_col="DAY"):
+    day = pl.col(time_col).dt
+    return frame.with_columns(
+        day_of_month=day.day(),
+        day_of_year=day.ordinal_day(),
+        month=day.month(),
+        year=day.year(),
+        week=day.week(),
+        # 0 is Monday
+        weekday=day.weekday() - 1,
+    )
+
+
+def add_school_holidays(frame, school_holidays, *, time_col="DAY"):
+    # school_holidays: the table of the education ministry (download_holidays.py)
+    paris = school_holidays.lazy().filter(
+        pl.col("location") == "Paris", pl.col("population").is_in(["-", "Élèves"])
+    )
+    start = paris.select(
+        holiday_event=pl.col("start_date").cast(pl.Date),
+        is_school_holiday=pl.lit(1, pl.Int32),
+    )
+    end = paris.select(
+        holiday_event=pl.col("end_date").cast(pl.Date),
+        is_school_holiday=pl.lit(0, pl.Int32),
+    )
+    events = pl.concat([start, end]).sort("holiday_event")
+    return (
+        frame.sort(time_col)
+        .join_asof(events, left_on=time_col, right_on="holiday_event")
+        .drop("holiday_event")
+        .with_columns(pl.col("is_school_holiday").fill_null(0))
+    )
+
+
+def add_holidays(frame, holidays, *, time_col="DAY"):
+    # holidays: the public holidays table, with a date column
+    days = holidays.lazy().select(pl.col("date").cast(pl.Date).unique().alias(time_col))
+    return frame.join(
+        days.with_columns(is_holiday=pl.lit(True)), on=time_col, how="left"
+    ).with_columns(pl.col("is_holiday").fill_null(False))
+
+
+def build_features(
+    counts,
+    *,
+    lagged=True,
+    school_holidays=None,
+    holidays=None,
+    lags=LAGS,
+    avg_widths=AVG_WIDTHS,
+    key="LINE",
+    time_col="DAY",
+):
+    # the features of every day of the grid, without N; the holiday features
+    # are only added when their table is given
+    frame = line_time_grid(counts, key=key, time_col=time_col)
+    if lagged:
+        frame = add_lagged_features(frame, lags, avg_widths, key=key, time_col=time_col)
+    frame = add_datetime_features(frame, time_col=time_col)
+    if school_holidays is not None:
+        frame = add_school_holidays(frame, school_holidays, time_col=time_col)
+    if holidays is not None:
+        frame = add_holidays(frame, holidays, time_col=time_col)
+    return frame.drop("N").sort(time_col, key)
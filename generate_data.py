@@ -0,0 +1,366 @@
+"""Write synthetic validation data in the layout of the IDFM open data.
+
+Creates data/<year>/reseau_de_surface.zip and reseau_ferre.zip, as downloaded
+by download.py, and the holiday tables created by download_holidays.py, so
+that the scripts can run (and be load-tested) without network access:
+
+    python generate_data.py --n_lines 1500 --n_stops 750  # ~ production scale
+    python download.py --skip_download
+
+Like the real files, the CSVs are latin-1 encoded, use ';' in some years and
+tabs in others, report small counts as "Moins de 5" and have rows with
+undefined line labels, line codes and ticket categories. Lines T2 and T3a
+(100__112__12 and 100__112__13) always exist.
+
+The benchmarks and the tests draw their data from the same generator:
+surface_validations() returns the rows of the surface files as one frame and
+daily_counts() the cleaned counts of data_access.load_surface().
+"""
+import argparse
+from datetime import date, timedelta
+import pathlib
+import zipfile
+
+import duckdb
+import numpy as np
+import polars as pl
+
+OUT_DIR = pathlib.Path(__file__).parent / "data"
+CATEGORIES = [
+    "NAVIGO",
+    "IMAGINE R",
+    "NAVIGO JOUR",
+    "AMETHYSTE",
+    "TST",
+    "FGT",
+    "AUTRE TITRE",
+    "NON DEFINI",
+    "?",
+]
+UNDEFINED_LABELS = ["?", "NON DEFINI", "LIGNE NON DEFINIE"]
+# share of the days on which a line (or stop) has no validations at all
+MISSING_DAYS = 0.02
+# relative traffic from Monday to Sunday
+WEEKDAY_PROFILE = np.array([1.0, 1.05, 1.05, 1.05, 1.0, 0.6, 0.4])
+PUBLIC_HOLIDAYS = [
+    (1, 1),
+    (5, 1),
+    (5, 8),
+    (7, 14),
+    (8, 15),
+    (11, 1),
+    (11, 11),
+    (12, 25),
+]
+# (start, end) month and day of the Paris school holidays
+SCHOOL_HOLIDAYS = [
+    ((2, 17), (3, 4)),
+    ((4, 14), (4, 30)),
+    ((7, 6), (9, 2)),
+    ((10, 19), (11, 4)),
+    ((12, 21), (1, 6)),
+]
+
+
+def _lines(n_lines, rng):
+    # 12 and 13 are kept for T2 and T3a
+    codes = rng.choice(np.arange(14, max(1000, 2 * n_lines)), n_lines, replace=False)
+    codes[:2] = [12, 13]
+    res = rng.integers(100, 130, n_lines)
+    res[:2] = 112
+    trns = rng.choice([100, 800, 810], n_lines)
+    trns[:2] = 100
+    names = [f"BUS {c}" for c in codes]
+    names[:2] = ["T2", "T3A"]
+    lines = pl.DataFrame(
+        {
+            # codes come with and without padding, as in the real files
+            "CODE_STIF_TRNS": trns.astype(str),
+            "CODE_STIF_RES": [f" {r}" if i % 3 else str(r) for i, r in enumerate(res)],
+            "CODE_STIF_LIGNE": codes.astype(str),
+            "LIBELLE_LIGNE": names,
+            "ID_GROUPOFLINES": [f"C{c:05d}" for c in rng.integers(0, 99999, n_lines)],
+        }
+    )
+    # validations that could not be attributed to a line
+    unknown = pl.DataFrame(
+        {
+            "CODE_STIF_TRNS": ["100"],
+            "CODE_STIF_RES": ["ND"],
+            "CODE_STIF_LIGNE": ["ND"],
+            "LIBELLE_LIGNE": ["LIGNE NON DEFINIE"],
+            "ID_GROUPOFLINES": ["?"],
+        }
+    )
+    return pl.concat([lines, unknown])
+
+
+def _stops(n_stops, rng):
+    codes = rng.choice(np.arange(1, max(10000, 2 * n_stops)), n_stops, replace=False)
+    return pl.DataFrame(
+        {
+            "CODE_STIF_TRNS": rng.choice(["100", "800", "810"], n_stops),
+            "CODE_STIF_RES": rng.choice(["110", "800", "810"], n_stops),
+            "CODE_STIF_ARRET": codes.astype(str),
+            "LIBELLE_ARRET": [f"GARE {c}" for c in codes],
+            "ID_REFA_LDA": rng.integers(59000, 480000, n_stops).astype(str),
+        }
+    )
+
+
+def school_holidays(first_year, last_year):
+    periods = [
+        (date(year, *start), date(year + (end < start), *end))
+        for year in range(first_year, last_year + 1)
+        for start, end in SCHOOL_HOLIDAYS
+    ]
+    return pl.DataFrame(
+        {
+            "description": "Vacances",
+            "population": "-",
+            "start_date": [start for start, _ in periods],
+            "end_date": [end for _, end in periods],
+            "location": "Paris",
+            "zones": "Zone C",
+            "annee_scolaire": [
+                f"{s.year - 1}-{s.year}" if s.month < 9 else f"{s.year}-{s.year + 1}"
+                for s, _ in periods
+            ],
+        }
+    )
+
+
+def public_holidays(first_year, last_year):
+    days = [
+        date(year, month, day)
+        for year in range(first_year, last_year + 1)
+        for month, day in PUBLIC_HOLIDAYS
+    ]
+    return pl.DataFrame(
+        {
+            "date": days,
+            "annee": [d.year for d in days],
+            "zone": "Métropole",
+            "nom_jour_ferie": "jour férié",
+        }
+    )
+
+
+def _traffic_profile(days, school, public):
+    # multiplicative effect of the calendar on all lines
+    days = pl.Series(days)
+    profile = WEEKDAY_PROFILE[days.dt.weekday().to_numpy() - 1]
+    in_school_holidays = np.zeros(len(days), dtype=bool)
+    for start, end in school.select("start_date", "end_date").iter_rows():
+        in_school_holidays |= ((days >= start) & (days < end)).to_numpy()
+    profile = profile * np.where(in_school_holidays, 0.8, 1.0)
+    return profile * np.where(days.is_in(public["date"]).to_numpy(), 0.45, 1.0)
+
+
+class _Series:
+    # lines (or stops) with their mean daily validations, opening and closing
+    # days and split over ticket categories
+    def __init__(self, keys, n_categories, first_day, n_days, rng):
+        self.keys = keys
+        self.categories = CATEGORIES[:n_categories]
+        n = keys.height
+        self.level = rng.lognormal(7.0, 1.5, n)
+        # a few series open after the first day or close before the last one
+        self.opening = first_day + rng.integers(0, n_days, n) * (rng.random(n) < 0.1)
+        self.closing = (
+            first_day + n_days - rng.integers(0, n_days, n) * (rng.random(n) < 0.1)
+        )
+        self.opening[:2] = first_day
+        self.closing[:2] = first_day + n_days
+        self.shares = rng.dirichlet(np.full(n_categories, 0.7), n)
+
+    def daily(self, days, profile, rng):
+        # (day, series) mean validations
+        days_arr = days.to_numpy()[:, None]
+        mean = profile[:, None] * self.level[None, :]
+        mean = mean * rng.lognormal(0.0, 0.15, mean.shape)
+        active = (days_arr >= self.opening) & (days_arr < self.closing)
+        return mean * active * (rng.random(mean.shape) >= MISSING_DAYS)
+
+    def validations(self, days, profile, label_col, rng):
+        days_arr = days.to_numpy()
+        # (day, series, category), the order of the real files
+        mean = self.daily(days, profile, rng)[:, :, None] * self.shares[None, :, :]
+        counts = rng.poisson(mean).ravel()
+        day_idx, series_idx, category_idx = np.unravel_index(
+            np.arange(counts.size), mean.shape
+        )
+        keep = counts > 0
+        rows = self.keys[series_idx[keep]].with_columns(
+            JOUR=pl.Series(days_arr[day_idx[keep]]).cast(pl.Date),
+            CATEGORIE_TITRE=pl.Series(self.categories)[category_idx[keep]],
+            N=counts[keep],
+        )
+        undefined = pl.Series(rng.random(rows.height) < 0.01)
+        labels = pl.Series(rng.choice(UNDEFINED_LABELS, rows.height))
+        label = pl.when(undefined).then(labels).otherwise(pl.col(label_col))
+        return rows.with_columns(
+            label.alias(label_col),
+            NB_VALD=pl.when(pl.col("N") < 5)
+            .then(pl.lit("Moins de 5"))
+            .otherwise(pl.col("N").cast(pl.String)),
+        ).select("JOUR", *self.keys.columns, "CATEGORIE_TITRE", "NB_VALD")
+
+
+def _write_member(archive, name, separator, chunks):
+    # written month by month so that memory does not grow with the data
+    with archive.open(name, "w", force_zip64=True) as stream:
+        for i, chunk in enumerate(chunks):
+            text = chunk.write_csv(separator=separator, include_header=i == 0)
+            stream.write(text.encode("latin-1"))
+
+
+def _write_year(out_file, members):
+    tmp = out_file.with_name(f"{out_file.name}.tmp")
+    with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, separator, chunks in members:
+            _write_member(archive, name, separator, chunks)
+    tmp.replace(out_file)
+    print(f"{out_file}: {out_file.stat().st_size / 2**20:,.1f} MiB")
+
+
+def _months(days):
+    days = pl.Series(days)
+    for month in days.dt.truncate("1mo").unique(maintain_order=True):
+        yield days.filter(days.dt.truncate("1mo") == month)
+
+
+def _calendar(first_day, n_days):
+    days = pl.date_range(first_day, first_day + timedelta(days=n_days - 1), eager=True)
+    school = school_holidays(first_day.year - 1, days[-1].year)
+    public = public_holidays(first_day.year, days[-1].year)
+    return days, school, public
+
+
+def surface_validations(
+    n_lines, n_days, n_categories=len(CATEGORIES), seed=0, first_day=date(2015, 1, 1)
+):
+    # the rows of the surface files for n_days from first_day, as one frame
+    rng = np.random.default_rng(seed)
+    days, school, public = _calendar(first_day, n_days)
+    surface = _Series(
+        _lines(n_lines, rng), n_categories, np.datetime64(first_day, "D"), n_days, rng
+    )
+    return pl.concat(
+        surface.validations(
+            month, _traffic_profile(month, school, public), "LIBELLE_LIGNE", rng
+        )
+        for month in _months(days)
+    )
+
+
+def daily_counts(n_lines, n_days, seed=0, first_day=date(2015, 1, 1)):
+    # DAY, LINE, N, LINE_NAME as returned by data_access.load_surface(), drawn
+    # like the files but without going through them
+    rng = np.random.default_rng(seed)
+    days, school, public = _calendar(first_day, n_days)
+    lines = _lines(n_lines, rng).head(n_lines)
+    series = _Series(lines, 1, np.datetime64(first_day, "D"), n_days, rng)
+    profile = _traffic_profile(days, school, public)
+    counts = rng.poisson(series.daily(days, profile, rng))
+    day_idx, line_idx = np.nonzero(counts)
+    codes = [
+        pl.col(c).str.strip_chars()
+        for c in ["CODE_STIF_TRNS", "CODE_STIF_RES", "CODE_STIF_LIGNE"]
+    ]
+    return (
+        lines[line_idx]
+        .select(
+            DAY=days.gather(day_idx),
+            LINE=pl.concat_str(codes, separator="__"),
+            N=pl.Series(counts[day_idx, line_idx]),
+            LINE_NAME="LIBELLE_LIGNE",
+        )
+        .sort("DAY", "LINE")
+    )
+
+
+def generate(first_year, last_year, n_lines, n_stops, n_categories, seed=0):
+    rng = np.random.default_rng(seed)
+    school = school_holidays(first_year - 1, last_year)
+    public = public_holidays(first_year, last_year)
+    first_day = date(first_year, 1, 1)
+    n_days = (date(last_year, 12, 31) - first_day).days + 1
+    first_day = np.datetime64(first_day, "D")
+    surface = _Series(_lines(n_lines, rng), n_categories, first_day, n_days, rng)
+    rail = _Series(_stops(n_stops, rng), n_categories, first_day, n_days, rng)
+    for i, year in enumerate(range(first_year, last_year + 1)):
+        year_dir = OUT_DIR / str(year)
+        year_dir.mkdir(parents=True, exist_ok=True)
+        # the archives of some years have a data-r*-<year> directory, and
+        # their files are separated by ';' rather than tabs
+        separator, prefix = (";", "data-{key}-{year}/") if i % 2 else ("\t", "")
+        semesters = [
+            (1, pl.date_range(date(year, 1, 1), date(year, 6, 30), eager=True)),
+            (2, pl.date_range(date(year, 7, 1), date(year, 12, 31), eager=True)),
+        ]
+        for key, long_key, series, label_col, archive_name in [
+            ("rs", "SURFACE", surface, "LIBELLE_LIGNE", "reseau_de_surface"),
+            ("rf", "FER", rail, "LIBELLE_ARRET", "reseau_ferre"),
+        ]:
+            members = [
+                (
+                    f"{prefix.format(key=key, year=year)}"
+                    f"{year}_S{semester}_NB_{long_key}.txt",
+                    separator,
+                    (
+                        series.validations(
+                            month,
+                            _traffic_profile(month, school, public),
+                            label_col,
+                            rng,
+                        )
+                        for month in _months(days)
+                    ),
+                )
+                for semester, days in semesters
+            ]
+            _write_year(year_dir / f"{archive_name}.zip", members)
+    return school, public
+
+
+def write_holidays(school, public):
+    # same files and tables as download_holidays.py
+    school_file = OUT_DIR / "school_holidays.parquet"
+    school.write_parquet(school_file)
+    holidays_file = OUT_DIR / "holidays.csv"
+    public.write_csv(holidays_file)
+    con = duckdb.connect(OUT_DIR / "ratp.duckdb")
+    con.sql(
+        "create table if not exists school_holidays as "
+        f"select * from read_parquet('{school_file}')"
+    )
+    con.sql(
+        "create table if not exists holidays as "
+        f"select * from read_csv('{holidays_file}')"
+    )
+    con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--first_year", type=int, default=2015)
+    parser.add_argument("--last_year", type=int, default=2023)
+    parser.add_argument("--n_lines", type=int, default=200)
+    # rail stations
+    parser.add_argument("--n_stops", type=int, default=100)
+    parser.add_argument(
+        "--n_categories", type=int, default=len(CATEGORIES), help="ticket categories"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    OUT_DIR.mkdir(exist_ok=True)
+    school, public = generate(
+        args.first_year,
+        args.last_year,
+        args.n_lines,
+        args.n_stops,
+        args.n_categories,
+        args.seed,
+    )
+    write_holidays(school, public)
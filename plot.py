@@ -5,8 +5,8 @@ from matplotlib import pyplot as plt
 from data_access import (
     load_data_points,
     load_surface_features,
-    polars_regular_time_grid,
 )
+from features import line_time_grid
 
 
 matplotlib.use("tkagg")
@@ -14,7 +14,7 @@ T2 = "100__112__12"
 
 results = pl.read_parquet("cv_predictions.parquet")
 results = results.filter(pl.col("LINE") == T2)
-results = polars_regular_time_grid(results)
+results = line_time_grid(results, 0).collect()
 fig, ax = plt.subplots()
 ax.plot(results["DAY"], results["N"])
 ax.plot(results["DAY"], results["predicted"])
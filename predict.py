@@ -3,22 +3,97 @@ import pickle
 import datetime
 
 import polars as pl
-import ibis
+import pyarrow.parquet as pq
+
+from artifact import feature_schema, load_model
+from data_access import (
+    GRID_EXTENSION_DAYS,
+    MIN_LAG,
+    add_horizons,
+    connect,
+    load_surface,
+    load_surface_features_at,
+)
 
 parser = argparse.ArgumentParser()
 parser.add_argument("date")
+parser.add_argument("--end", default=None, help="last day to predict (inclusive)")
+parser.add_argument("--line", nargs="+", default=["100__112__12"], help="or 'all'")
+parser.add_argument("--output", default=None, help="write predictions to parquet")
+parser.add_argument("--chunk_size", type=int, default=100_000)
+parser.add_argument(
+    "--artifact",
+    default=None,
+    help="use the compact model exported by train.py instead of best-model.pickle",
+)
 args = parser.parse_args()
-date = datetime.date.fromisoformat(args.date)
+start = datetime.date.fromisoformat(args.date)
+end = datetime.date.fromisoformat(args.end) if args.end is not None else start
+
+connection = connect()
+
+if args.line == ["all"]:
+    lines = load_surface(connection).select("LINE").distinct().to_polars()
+else:
+    lines = pl.DataFrame({"LINE": args.line})
+days = pl.DataFrame({"DAY": pl.date_range(start, end, eager=True)})
+query = add_horizons(connection, days.join(lines, how="cross"))
+
+# only compute the features of the requested points instead of the whole table
+features = load_surface_features_at(connection, query)
+query = query.join(
+    features.select("DAY", "LINE"), on=["DAY", "LINE"], how="semi"
+).sort(["DAY", "LINE"])
+n_missing = days.height * lines.height - query.height
+if n_missing:
+    print(f"{n_missing:,} points skipped: unknown line or too far in the future")
+n_partial = query.filter(pl.col("horizon") > MIN_LAG).height
+if n_partial:
+    print(
+        f"{n_partial:,} points are more than {MIN_LAG} days after the last "
+        "observation of their line: some lagged features are missing "
+        f"(up to {GRID_EXTENSION_DAYS} days is allowed)"
+    )
+assert query.height, "Nothing to predict"
+
+if args.artifact is None:
+    with open("best-model.pickle", "rb") as stream:
+        model = pickle.load(stream)
 
-assert date < datetime.date(2023, 1, 11), "Too far in the future"
+    def predict(chunk):
+        return model.predict(
+            {"all_days": chunk.select("DAY", "LINE"), "features": features}
+        )
 
-connection = ibis.duckdb.connect("data/ratp.duckdb", read_only=True)
+else:
+    model = load_model(feature_schema(features), args.artifact)
 
-query = pl.DataFrame({"DAY": [date], "LINE": ["100__112__12"]})
+    def predict(chunk):
+        points = chunk.select("DAY", "LINE").join(
+            features, on=["DAY", "LINE"], how="left"
+        )
+        return model.predict(points.sort(["DAY", "LINE"]))
 
-with open("best-model.pickle", "rb") as stream:
-    model = pickle.load(stream)
 
-prediction = model.predict({"all_days": query, "connection": connection})
+# both models return predictions in (DAY, LINE) order, query is sorted
+chunks = (
+    chunk.with_columns(predicted=predict(chunk))
+    for chunk in query.iter_slices(args.chunk_size)
+)
 
-print(f"prediction: {int(prediction[0]):,} travellers on {date:%a %d %b %Y}")
+if args.output is None:
+    predictions = pl.concat(chunks)
+    if predictions.height == 1:
+        prediction = predictions["predicted"][0]
+        print(f"prediction: {int(prediction):,} travellers on {start:%a %d %b %Y}")
+    else:
+        print(predictions)
+else:
+    writer = None
+    for chunk in chunks:
+        table = chunk.to_arrow()
+        if writer is None:
+            writer = pq.ParquetWriter(args.output, table.schema)
+        writer.write_table(table)
+    writer.close()
+    print(f"predictions written to {args.output}")
@@ -0,0 +1,282 @@
+"""Stop-level forecasts for the rail network.
+
+There are many more stops in the rail table than lines in the surface table,
+so the daily counts per stop are exported to parquet files partitioned by a
+hash bucket of the stop, sorted by STOP then DAY (the row group statistics
+then let readers skip to a stop), and features and models are computed one
+bucket at a time:
+
+    python rail.py --export  # write data/rail_stops/BUCKET=*/data.parquet
+    python rail.py           # fit one model per bucket in rail-models/
+    python rail.py --predict 2023-06-01 --end 2023-06-07 --stop 100__110__8738400
+
+Peak memory is set by the size of a bucket (times --n_jobs), not by the
+number of stops. A prediction hashes each requested stop to its bucket and only
+reads the row groups of the requested stops.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import pickle
+from pathlib import Path
+import shutil
+
+import ibis
+from ibis import _
+from joblib import Parallel, delayed
+import polars as pl
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.metrics import mean_absolute_percentage_error
+from sklearn.preprocessing import OrdinalEncoder
+
+from data_access import DATABASE, connect, load_table
+from evaluation import Splitter
+from features import build_features
+import tracing
+
+RAIL_DIR = Path(__file__).parent / "data" / "rail_stops"
+MODEL_DIR = Path("rail-models")
+N_BUCKETS = 64
+# recorded with each export, see stop_buckets()
+BUCKET_HASH = "md5"
+ROW_GROUP_SIZE = 100_000
+
+
+def load_rail(con):
+    # daily counts per stop, cleaned like load_surface() cleans the lines
+    rail = con.table("rail")
+    rail = rail.mutate(
+        N=_.NB_VALD.strip().re_replace("Moins de 5", "4").cast(int),
+        LIBELLE_ARRET=(
+            _.LIBELLE_ARRET.isin(["?", "NON DEFINI", ""]).ifelse(
+                ibis.null(), _.LIBELLE_ARRET
+            )
+        ),
+    )
+    code_cols = ["CODE_STIF_TRNS", "CODE_STIF_RES", "CODE_STIF_ARRET"]
+    rail = rail.mutate(**{c: _[c].cast(str).strip().try_cast(int) for c in code_cols})
+    rail = rail.filter(*[_[c].notnull() for c in code_cols])
+    rail = rail.mutate(
+        STOP=ibis.array([_[c].cast(str) for c in code_cols]).join("__"), DAY=_.JOUR
+    )
+    return rail.group_by("DAY", "STOP").agg(
+        N=_.N.sum(), STOP_NAME=_.LIBELLE_ARRET.first()
+    )
+
+
+def stop_buckets(stops, n_buckets=N_BUCKETS):
+    # The bucket of each of `stops`, from the md5 of its code: unlike the hash
+    # functions of duckdb or polars it does not change between versions.
+    buckets = [
+        int.from_bytes(hashlib.md5(stop.encode("utf-8")).digest()[:8], "little")
+        % n_buckets
+        for stop in stops
+    ]
+    schema = {"STOP": pl.String, "BUCKET": pl.Int64}
+    return pl.DataFrame({"STOP": stops, "BUCKET": buckets}, schema=schema)
+
+
+def export_stop_counts(con, counts, out_dir=RAIL_DIR, n_buckets=N_BUCKETS):
+    # counts: DAY, STOP, N, STOP_NAME (the output of load_rail). Sorted once by
+    # bucket so that writing each bucket only reads its own row groups. The
+    # number of buckets and the hash are recorded for predict().
+    stops = con.to_polars(counts.select("STOP").distinct())["STOP"]
+    counts = counts.join(ibis.memtable(stop_buckets(stops, n_buckets)), "STOP")
+    tmp_dir = out_dir.with_name(f"{out_dir.name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    staged = tmp_dir / "all.parquet"
+    with tracing.stage("rail.sort"):
+        con.to_parquet(counts.order_by("BUCKET", "STOP", "DAY"), staged)
+    for bucket in range(n_buckets):
+        bucket_dir = tmp_dir / f"BUCKET={bucket}"
+        bucket_dir.mkdir()
+        bucket_counts = (
+            con.read_parquet(staged)
+            .filter(_.BUCKET == bucket)
+            .drop("BUCKET")
+            .order_by("STOP", "DAY")
+        )
+        con.to_parquet(
+            bucket_counts, bucket_dir / "data.parquet", row_group_size=ROW_GROUP_SIZE
+        )
+    staged.unlink()
+    metadata = {"n_buckets": n_buckets, "hash": BUCKET_HASH}
+    (tmp_dir / "metadata.json").write_text(json.dumps(metadata, indent=2))
+    shutil.rmtree(out_dir, ignore_errors=True)
+    tmp_dir.replace(out_dir)
+
+
+def bucket_count(data_dir=RAIL_DIR):
+    # the number of buckets of an export, checking it used stop_buckets()
+    path = data_dir / "metadata.json"
+    metadata = json.loads(path.read_text()) if path.is_file() else {}
+    if metadata.get("hash") != BUCKET_HASH:
+        raise ValueError(
+            f"{data_dir} was not exported with the {BUCKET_HASH} bucket hash: "
+            "run rail.py --export again"
+        )
+    return metadata["n_buckets"]
+
+
+def buckets(data_dir=RAIL_DIR):
+    return sorted(int(p.name.split("=")[1]) for p in data_dir.glob("BUCKET=*"))
+
+
+def load_stop_counts(bucket, data_dir=RAIL_DIR):
+    return pl.scan_parquet(
+        data_dir / f"BUCKET={bucket}" / "*.parquet", hive_partitioning=False
+    )
+
+
+def load_stop_features(con, bucket, data_dir=RAIL_DIR):
+    # load_surface_features() for the stops of one bucket, as a LazyFrame
+    return build_features(
+        load_stop_counts(bucket, data_dir),
+        school_holidays=load_table(con, "school_holidays"),
+        holidays=load_table(con, "holidays"),
+        key="STOP",
+    )
+
+
+def load_stop_features_at(con, keys, bucket, data_dir=RAIL_DIR):
+    # load_stop_features() joined with `keys` (DAY and STOP, all in `bucket`):
+    # only the history of the requested stops is read, and points outside of
+    # their stop's time grid have no features. Returns a polars dataframe.
+    keys = keys.select(pl.col("DAY").cast(pl.Date), "STOP").unique()
+    counts = load_stop_counts(bucket, data_dir).filter(
+        pl.col("STOP").is_in(keys["STOP"].unique().implode())
+    )
+    features = build_features(
+        counts,
+        school_holidays=load_table(con, "school_holidays"),
+        holidays=load_table(con, "holidays"),
+        key="STOP",
+    )
+    return (
+        features.join(keys.lazy(), on=["DAY", "STOP"], how="semi")
+        .sort("DAY", "STOP")
+        .collect()
+    )
+
+
+def _fit(data):
+    # data: DAY, STOP, N and the features, sorted by DAY
+    encoder = OrdinalEncoder(
+        unknown_value=float("nan"), handle_unknown="use_encoded_value"
+    )
+    X = data.drop("DAY", "N").with_columns(
+        STOP=encoder.fit_transform(data.select("STOP"))[:, 0]
+    )
+    model = HistGradientBoostingRegressor(
+        early_stopping=True, n_iter_no_change=10, max_iter=1000
+    )
+    model.fit(X, data["N"])
+    return {"encoder": encoder, "model": model}
+
+
+def _predict(fitted, features):
+    encoder, model = fitted["encoder"], fitted["model"]
+    X = features.with_columns(STOP=encoder.transform(features.select("STOP"))[:, 0])
+    return model.predict(X.select(model.feature_names_in_))
+
+
+def fit_bucket(bucket, database=DATABASE, data_dir=RAIL_DIR, model_dir=MODEL_DIR):
+    con = connect(database)
+    with tracing.stage("rail.fit_bucket", bucket=bucket) as trace:
+        counts = load_stop_counts(bucket, data_dir).select("DAY", "STOP", "N")
+        features = load_stop_features(con, bucket, data_dir).drop("STOP_NAME")
+        data = counts.join(features, on=["DAY", "STOP"], how="inner")
+        data = data.sort("DAY", "STOP").collect()
+        trace["rows_in"] = data.height
+        if data.is_empty():
+            return bucket, 0, None
+        # error on the last split of evaluation.Splitter, then refit on all days
+        cv_mape = None
+        for train_idx, test_idx in Splitter(max_splits=1).split_slices(data):
+            test_data = data[test_idx]
+            pred = _predict(_fit(data[train_idx]), test_data.drop("N"))
+            cv_mape = mean_absolute_percentage_error(test_data["N"], pred)
+        fitted = _fit(data)
+        trace["cv_mape"] = cv_mape
+    model_dir.mkdir(exist_ok=True)
+    with open(model_dir / f"bucket-{bucket:03d}.pickle", "wb") as stream:
+        pickle.dump({**fitted, "cv_mape": cv_mape}, stream)
+    return bucket, data.height, cv_mape
+
+
+def train(n_jobs=1, database=DATABASE, data_dir=RAIL_DIR, model_dir=MODEL_DIR):
+    jobs = [
+        delayed(fit_bucket)(bucket, database, data_dir, model_dir)
+        for bucket in buckets(data_dir)
+    ]
+    results = Parallel(n_jobs=n_jobs, return_as="generator_unordered")(jobs)
+    for bucket, n_rows, cv_mape in results:
+        error = "" if cv_mape is None else f", CV MAPE {cv_mape:.3f}"
+        print(f"bucket {bucket}: {n_rows:,} rows{error}")
+
+
+def predict(keys, database=DATABASE, data_dir=RAIL_DIR, model_dir=MODEL_DIR):
+    # keys: a polars dataframe with DAY and STOP. Returns DAY, STOP and the
+    # prediction of the model of the stop's bucket, for the points that have
+    # features (known stop, at most GRID_EXTENSION_DAYS after its last day).
+    con = connect(database)
+    stops = stop_buckets(keys["STOP"].unique(), bucket_count(data_dir))
+    keys = keys.join(stops, on="STOP")
+    predictions = []
+    for (bucket,), bucket_keys in keys.group_by("BUCKET"):
+        model_path = model_dir / f"bucket-{bucket:03d}.pickle"
+        if not model_path.is_file():
+            continue
+        with tracing.stage("rail.predict", bucket=bucket) as trace:
+            with open(model_path, "rb") as stream:
+                fitted = pickle.load(stream)
+            features = load_stop_features_at(con, bucket_keys, bucket, data_dir)
+            trace["rows_out"] = features.height
+            if features.is_empty():
+                continue
+            predictions.append(
+                features.select("DAY", "STOP").with_columns(
+                    prediction=_predict(fitted, features.drop("STOP_NAME"))
+                )
+            )
+    if not predictions:
+        return pl.DataFrame(
+            schema={"DAY": pl.Date, "STOP": pl.String, "prediction": pl.Float64}
+        )
+    return pl.concat(predictions).sort("DAY", "STOP")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--export", action="store_true")
+    parser.add_argument("--n_buckets", type=int, default=N_BUCKETS)
+    # every job holds one bucket in memory
+    parser.add_argument("--n_jobs", type=int, default=1)
+    parser.add_argument("--trace", default=None)
+    parser.add_argument("--predict", default=None, help="first day to predict")
+    parser.add_argument("--end", default=None, help="last day to predict (inclusive)")
+    parser.add_argument("--stop", nargs="+", default=[])
+    parser.add_argument("--output", default=None, help="write predictions to parquet")
+    args = parser.parse_args()
+    if args.trace is not None:
+        tracing.start(args.trace)
+    if args.predict is not None:
+        start = datetime.date.fromisoformat(args.predict)
+        end = datetime.date.fromisoformat(args.end) if args.end else start
+        days = pl.DataFrame({"DAY": pl.date_range(start, end, eager=True)})
+        query = days.join(pl.DataFrame({"STOP": args.stop}), how="cross")
+        predictions = predict(query)
+        n_missing = query.height - predictions.height
+        if n_missing:
+            print(f"{n_missing:,} points skipped: unknown stop or too far ahead")
+        if args.output is not None:
+            predictions.write_parquet(args.output)
+        else:
+            print(predictions)
+    else:
+        if args.export or not RAIL_DIR.is_dir():
+            con = connect()
+            export_stop_counts(con, load_rail(con), n_buckets=args.n_buckets)
+        train(args.n_jobs)
@@ -0,0 +1,149 @@
+"""Keep the model and the feature table in memory and answer prediction requests.
+
+POST a JSON object with a list of dates and a list of lines:
+
+    curl localhost:8000 -d '{"DAY": ["2023-01-02"], "LINE": ["100__112__12"]}'
+
+The reply contains the points sorted by (DAY, LINE) with their predictions.
+
+The feature table is indexed by (LINE, DAY) at startup, and each request only
+gathers its own rows and runs the fitted encoder and trees on them, rather than
+evaluating the whole skrub pipeline (and its join with the feature table).
+"""
+import argparse
+import datetime
+import json
+import pickle
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import polars as pl
+
+from data_access import connect, load_cached_surface_features
+
+
+class FeatureIndex:
+    # The feature table sorted by (LINE, DAY). Every line has one row per day
+    # of its grid (features.line_time_grid), so the row of a point is the first
+    # row of its line plus the number of days since the line's first day.
+    def __init__(self, features):
+        self.features = features.sort("LINE", "DAY")
+        self.spans = (
+            self.features.select("LINE", "DAY")
+            .with_row_index("start")
+            .group_by("LINE")
+            .agg(
+                pl.col("start").first(),
+                first_day=pl.col("DAY").first(),
+                n_days=pl.len(),
+            )
+        )
+
+    def rows(self, query):
+        # row of each point of query, null when it has no features
+        offset = (pl.col("DAY") - pl.col("first_day")).dt.total_days()
+        return (
+            query.join(self.spans, on="LINE", how="left", maintain_order="left")
+            .select(
+                row=pl.when((offset >= 0) & (offset < pl.col("n_days"))).then(
+                    pl.col("start") + offset
+                )
+            )
+            .get_column("row")
+        )
+
+
+def load_predictor(model_path):
+    # the steps of the train.py pipeline that come after the join with the
+    # feature table, as fitted in best-model.pickle: the LINE encoder and the
+    # trees, which select their own columns
+    with open(model_path, "rb") as stream:
+        model = pickle.load(stream)
+    try:
+        encoder = model.find_fitted_estimator("line_encoder").transformer_
+    except ValueError:
+        raise ValueError(
+            f"{model_path} has no 'line_encoder' step: it was trained by an older "
+            "train.py, run train.py again"
+        )
+    hgb = model.find_fitted_estimator("hgb")
+
+    def predict(points):
+        X = points.with_columns(LINE=encoder.transform(points.select("LINE"))[:, 0])
+        return hgb.predict(X.select(hgb.feature_names_in_))
+
+    return predict
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            query = pl.DataFrame(
+                {
+                    "DAY": [datetime.date.fromisoformat(d) for d in body["DAY"]],
+                    "LINE": body["LINE"],
+                },
+                schema={"DAY": pl.Date, "LINE": pl.String},
+            )
+        except (KeyError, TypeError, ValueError, pl.exceptions.PolarsError) as e:
+            self._reply(400, {"error": f"invalid request: {e}"})
+            return
+        query = query.sort(["DAY", "LINE"])
+        rows = self.server.index.rows(query)
+        unknown = query.filter(rows.is_null())
+        if unknown.height:
+            self._reply(
+                400,
+                {
+                    "error": "no features for some points: unknown line, or "
+                    "date outside of the line's span (+10 days after its last "
+                    "data point)",
+                    "DAY": [str(d) for d in unknown["DAY"]],
+                    "LINE": unknown["LINE"].to_list(),
+                },
+            )
+            return
+        start = time.perf_counter()
+        if query.is_empty():
+            prediction = []
+        else:
+            points = self.server.index.features[rows.to_numpy()]
+            prediction = self.server.predict(points)
+        self._reply(
+            200,
+            {
+                "DAY": [str(d) for d in query["DAY"]],
+                "LINE": query["LINE"].to_list(),
+                "prediction": [float(p) for p in prediction],
+                "seconds": time.perf_counter() - start,
+            },
+        )
+
+    def _reply(self, status, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(host, port, model_path):
+    server = HTTPServer((host, port), PredictionHandler)
+    connection = connect()
+    server.predict = load_predictor(model_path)
+    print("Loading features")
+    server.index = FeatureIndex(load_cached_surface_features(connection))
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model", default="best-model.pickle")
+    args = parser.parse_args()
+    server = make_server(args.host, args.port, args.model)
+    print(f"Serving predictions on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -1,6 +1,9 @@
+import os
 import pickle
 from pathlib import Path
+import shutil
 
+from joblib import Parallel, delayed
 import polars as pl
 from sklearn.base import clone
 from sklearn.metrics import mean_absolute_percentage_error
@@ -8,23 +11,44 @@ from sklearn.metrics import mean_absolute_percentage_error
 import utils
 
 LINE_NAME = "T2"
+N_JOBS = -1
+PARTS_DIR = Path(f"{LINE_NAME}_cv_predictions.parts")
 
 
-def get_cv_predictions(usage, estimator):
-    all_test_data = []
-    for i, (train, test) in enumerate(utils.Splitter().split(usage)):
-        print(i)
-        train_data = usage.select(pl.all().gather(train))
-        test_data = usage.select(pl.all().gather(test))
-        print(f"  train: {train_data['DATE'].min()} - {train_data['DATE'].max()}")
-        print(f"  test:  {test_data['DATE'].min()} - {test_data['DATE'].max()}")
-        est = clone(estimator).fit({"data": train_data})
-        pred = est.predict({"data": test_data})
-        err = mean_absolute_percentage_error(test_data["N"], pred)
-        print(f"  MAPE: {err:.1%}")
-        all_test_data.append(test_data.with_columns(predicted=pred))
-
-    results = pl.concat(all_test_data)
+def fit_fold(estimator, i, train_data, test_data):
+    est = clone(estimator).fit({"data": train_data})
+    pred = est.predict({"data": test_data})
+    err = mean_absolute_percentage_error(test_data["N"], pred)
+    print(f"fold {i}")
+    print(f"  train: {train_data['DATE'].min()} - {train_data['DATE'].max()}")
+    print(f"  test:  {test_data['DATE'].min()} - {test_data['DATE'].max()}")
+    print(f"  MAPE: {err:.1%}")
+    # written as soon as the fold is done so a crash does not lose it, and
+    # renamed once complete so that a truncated part is never read
+    part = PARTS_DIR / f"fold-{i:03d}.parquet"
+    tmp_part = part.with_name(f"{part.name}.{os.getpid()}.tmp")
+    test_data.with_columns(predicted=pred).write_parquet(tmp_part)
+    tmp_part.replace(part)
+    return i
+
+
+def get_cv_predictions(usage, estimator, n_jobs=N_JOBS):
+    shutil.rmtree(PARTS_DIR, ignore_errors=True)
+    PARTS_DIR.mkdir()
+    splits = utils.Splitter().split_slices(usage)
+    Parallel(n_jobs=n_jobs)(
+        delayed(fit_fold)(
+            estimator,
+            i,
+            usage[train],
+            usage[test],
+        )
+        for i, (train, test) in enumerate(splits)
+    )
+    results = pl.concat(
+        pl.read_parquet(PARTS_DIR / f"fold-{i:03d}.parquet")
+        for i in range(len(splits))
+    )
     return results
 
 
@@ -0,0 +1,219 @@
+"""Hyperparameter search that stops scoring bad candidates after a few folds.
+
+Candidates are scored fold by fold, newest fold first. With successive halving
+every candidate is scored on the newest fold, the best 1 / ETA of them on the
+ETA newest folds, and so on until the remaining ones have been scored on all
+folds. With backend="optuna" the same is done by an optuna study with a
+successive halving pruner (or the pruner given).
+
+The out-of-fold predictions of every (candidate, fold) are stored in
+search_cache/, keyed by the hash of the parameters, the dates of the fold, the
+feature and predictor versions and the fingerprint of the data, so that running
+the search again, with more candidates or after an interruption, only fits what
+is missing. The optuna study is named after the line, the versions and the data
+and resumed from the storage.
+"""
+import hashlib
+import json
+import math
+import os
+
+from joblib import Parallel, delayed
+import numpy as np
+import polars as pl
+from sklearn.metrics import median_absolute_error
+
+import utils
+
+ETA = 3
+search_cache_dir = utils.data_dir / "search_cache"
+
+
+def _params_hash(params):
+    content = json.dumps(params, sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+
+def _data_key(line_name):
+    # scores depend on the feature code, on get_predictor() and on the data
+    version = f"v{utils.FEATURE_SCHEMA_VERSION}.{utils.PREDICTOR_VERSION}"
+    return f"{version}-{utils.data_fingerprint(line_name)}"
+
+
+def _cache_path(line_name, params, train_data, test_data):
+    fold = "_".join(
+        str(d)
+        for d in [
+            train_data["DATE"].min(),
+            train_data["DATE"].max(),
+            test_data["DATE"].min(),
+            test_data["DATE"].max(),
+        ]
+    )
+    return (
+        search_cache_dir
+        / line_name
+        / _params_hash(params)
+        / f"{fold}-{_data_key(line_name)}.parquet"
+    )
+
+
+def score_fold(line_name, params, train_data, test_data):
+    # returns the score (as scoring="neg_median_absolute_error") and whether
+    # the predictions came from the cache
+    path = _cache_path(line_name, params, train_data, test_data)
+    cached = path.is_file()
+    if cached:
+        predictions = pl.read_parquet(path)
+    else:
+        learner = utils.get_predictor(line_name, params).skb.make_learner()
+        learner.fit({"data": train_data})
+        pred = learner.predict({"data": test_data})
+        predictions = test_data.select("DATE", "N").with_columns(predicted=pred)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        predictions.write_parquet(tmp_path)
+        tmp_path.replace(path)
+    score = -median_absolute_error(predictions["N"], predictions["predicted"])
+    return score, cached
+
+
+def _budgets(n_folds, eta):
+    # number of folds of each rung: 1, eta, eta**2, ... and finally all
+    budgets = []
+    budget = 1
+    while budget < n_folds:
+        budgets.append(budget)
+        budget *= eta
+    return budgets + [n_folds]
+
+
+def _report(n_scored, folds):
+    # n_scored: number of folds each candidate was scored on
+    n_fits = sum(n_scored)
+    n_full = len(n_scored) * len(folds)
+    rows = [train.stop for train, _ in folds]
+    train_rows = sum(sum(rows[:n]) for n in n_scored)
+    full_rows = len(n_scored) * sum(rows)
+    print(
+        f"{n_fits} of {n_full} fold fits ({1 - n_fits / n_full:.0%} saved), "
+        f"{1 - train_rows / full_rows:.0%} of the training rows saved"
+    )
+
+
+def _results_table(rows):
+    # rows: (params, mean score, number of folds). The columns of the randomized
+    # search's results_, plus the number of folds the mean is over; candidates
+    # scored on all folds come first.
+    return pl.DataFrame(
+        [
+            {**params, "mean_test_score": score, "n_folds": n_folds}
+            for params, score, n_folds in rows
+        ]
+    ).sort(["n_folds", "mean_test_score"], descending=True)
+
+
+def _halving(line_name, usage, folds, n_iter, eta, n_jobs, random_state):
+    candidates = utils.sample_params(n_iter, random_state)
+    scores = [[] for _ in candidates]
+    alive = list(range(n_iter))
+    for rung, budget in enumerate(_budgets(len(folds), eta)):
+        todo = [(c, k) for c in alive for k in range(len(scores[c]), budget)]
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(score_fold)(
+                line_name, candidates[c], usage[folds[k][0]], usage[folds[k][1]]
+            )
+            for c, k in todo
+        )
+        for (c, _), (score, _) in zip(todo, results):
+            scores[c].append(score)
+        n_cached = sum(cached for _, cached in results)
+        alive = sorted(alive, key=lambda c: np.mean(scores[c]), reverse=True)
+        print(
+            f"rung {rung}: {len(todo)} fits ({n_cached} cached), best of "
+            f"{len(alive)} on {budget} folds: {np.mean(scores[alive[0]]):.4g}"
+        )
+        if budget < len(folds):
+            alive = alive[: math.ceil(len(alive) / eta)]
+    _report([len(s) for s in scores], folds)
+    rows = [(p, np.mean(s), len(s)) for p, s in zip(candidates, scores)]
+    return candidates[alive[0]], _results_table(rows)
+
+
+def _suggest(trial):
+    params = {}
+    for name, choice in utils.get_choices().items():
+        if hasattr(choice, "outcomes"):
+            params[name] = trial.suggest_categorical(name, choice.outcomes)
+        elif choice.to_int:
+            params[name] = trial.suggest_int(
+                name, choice.low, choice.high, log=choice.log
+            )
+        else:
+            params[name] = trial.suggest_float(
+                name, choice.low, choice.high, log=choice.log
+            )
+    return params
+
+
+def _optuna(line_name, usage, folds, n_iter, n_jobs, storage, pruner):
+    import optuna
+
+    def objective(trial):
+        params = _suggest(trial)
+        scores = []
+        for k, (train, test) in enumerate(folds):
+            score, _ = score_fold(line_name, params, usage[train], usage[test])
+            scores.append(score)
+            trial.report(np.mean(scores), step=k)
+            if trial.should_prune():
+                raise optuna.TrialPruned()
+        return np.mean(scores)
+
+    study = optuna.create_study(
+        study_name=f"{line_name}-{_data_key(line_name)}",
+        direction="maximize",
+        storage=storage,
+        pruner=pruner or optuna.pruners.SuccessiveHalvingPruner(),
+        load_if_exists=True,
+    )
+    finished = [optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED]
+    # trials left running by an interrupted search are marked failed and their
+    # candidates tried again, with their finished folds from the cache. (The
+    # skip_if_exists check of enqueue_trial would match the stale trial itself.)
+    interrupted = study.get_trials(states=[optuna.trial.TrialState.RUNNING])
+    for trial in interrupted:
+        study.tell(trial.number, state=optuna.trial.TrialState.FAIL)
+        study.enqueue_trial(trial.params)
+    n_done = len(study.get_trials(states=finished))
+    print(f"{n_done} trials already done, {len(interrupted)} interrupted ones rerun")
+    study.optimize(objective, n_trials=max(0, n_iter - n_done), n_jobs=n_jobs)
+    trials = [t for t in study.get_trials(states=finished) if t.intermediate_values]
+    _report([len(t.intermediate_values) for t in trials], folds)
+    rows = []
+    for t in trials:
+        steps = t.intermediate_values
+        rows.append((t.params, steps[max(steps)], len(steps)))
+    return study.best_params, _results_table(rows)
+
+
+def halving_search(
+    line_name,
+    usage,
+    *,
+    n_iter=32,
+    eta=ETA,
+    cv=None,
+    n_jobs=-1,
+    backend=None,
+    storage=None,
+    pruner=None,
+    random_state=0,
+):
+    # returns the best parameters (for utils.get_predictor) and the results
+    # table; usage must be sorted by DATE
+    cv = cv if cv is not None else utils.Splitter()
+    folds = cv.split_slices(usage)[::-1]
+    if backend == "optuna":
+        return _optuna(line_name, usage, folds, n_iter, n_jobs, storage, pruner)
+    return _halving(line_name, usage, folds, n_iter, eta, n_jobs, random_state)
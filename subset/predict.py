@@ -1,13 +1,20 @@
+import argparse
 import datetime
 import pickle
 
 import polars as pl
 
+parser = argparse.ArgumentParser()
+parser.add_argument("date", nargs="?", default="2023-01-02")
+parser.add_argument("--end", default=None, help="last day to predict (inclusive)")
+args = parser.parse_args()
+start = datetime.date.fromisoformat(args.date)
+end = datetime.date.fromisoformat(args.end) if args.end is not None else start
 
 with open("model.pickle", "rb") as stream:
     model = pickle.load(stream)
 
-date = datetime.date(2023, 1, 2)
-data = pl.DataFrame({"DATE": [date]})
-pred = model.predict({"data": data})[0]
-print(f"prediction for {date}: {pred:,.0f} travellers")
+data = pl.DataFrame({"DATE": pl.date_range(start, end, eager=True)})
+pred = model.predict({"data": data})
+for date, p in zip(data["DATE"], pred):
+    print(f"prediction for {date}: {p:,.0f} travellers")
@@ -1,28 +1,58 @@
+import argparse
 import pickle
 
+import halving
 import utils
 
 LINE_NAME = "T2"
 
+parser = argparse.ArgumentParser()
+# score the candidates fold by fold, newest first, and stop scoring the worst
+# ones early: successive halving over the folds, or optuna's successive halving
+# pruner with the optuna backend
+parser.add_argument("--halving", action="store_true")
+parser.add_argument("--backend", default="optuna")
+# with --halving the fold scores are cached in search_cache/ and the optuna
+# study is resumed: rerunning with a larger --n_iter only fits the new
+# candidates
+parser.add_argument("--n_iter", type=int, default=32)
+args = parser.parse_args()
+
 usage = utils.load_usage(LINE_NAME).collect()
-pred = utils.get_predictor(LINE_NAME)
 db = 'sqlite:///optuna.sqlite3'
-search = pred.skb.make_randomized_search(
-    backend="optuna",
-    scoring="neg_median_absolute_error",
-    cv=utils.Splitter(),
-    n_iter=32,
-    n_jobs=8,
-    verbose=0,
-    storage=db,
-)
-search.fit({"data": usage})
-
-with open("search-model.pickle", "wb") as stream:
-    pickle.dump(search, stream)
-
-with open("best-model.pickle", "wb") as stream:
-    pickle.dump(search.best_learner_, stream)
-
-print(search.results_)
-search.plot_results().show()
+
+if args.halving:
+    best_params, results = halving.halving_search(
+        LINE_NAME,
+        usage,
+        n_iter=args.n_iter,
+        n_jobs=8,
+        backend=args.backend,
+        storage=db,
+    )
+    best_learner = utils.get_predictor(LINE_NAME, best_params).skb.make_learner()
+    best_learner.fit({"data": usage})
+    with open("best-model.pickle", "wb") as stream:
+        pickle.dump(best_learner, stream)
+    print(results)
+else:
+    pred = utils.get_predictor(LINE_NAME)
+    search = pred.skb.make_randomized_search(
+        backend=args.backend,
+        scoring="neg_median_absolute_error",
+        cv=utils.Splitter(),
+        n_iter=args.n_iter,
+        n_jobs=8,
+        verbose=0,
+        storage=db,
+    )
+    search.fit({"data": usage})
+
+    with open("search-model.pickle", "wb") as stream:
+        pickle.dump(search, stream)
+
+    with open("best-model.pickle", "wb") as stream:
+        pickle.dump(search.best_learner_, stream)
+
+    print(search.results_)
+    search.plot_results().show()
@@ -1,124 +1,168 @@
-from datetime import timedelta
+import fcntl
+import hashlib
+import os
 from pathlib import Path
+import sys
 
+import numpy as np
 import polars as pl
 from sklearn.base import clone
 from sklearn.ensemble import HistGradientBoostingRegressor
 from sklearn.metrics import mean_absolute_percentage_error
 import skrub
 
+# the feature engine and the data are shared with the scripts of the parent
+# directory
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from data_access import DATASET_DIR  # noqa: E402
+import evaluation  # noqa: E402
+from features import (  # noqa: E402
+    FEATURE_SCHEMA_VERSION,
+    build_features,
+    line_time_grid,
+)
+
 data_dir = Path(__file__).parent
+cache_dir = data_dir / "feature_cache"
+# written by download.py --export_dataset, see data_access.export_dataset()
+dataset_dir = DATASET_DIR
+FEATURE_CACHE = os.environ.get("SUBSET_FEATURE_CACHE", "1") != "0"
+LINES = {"T2": "100__112__12", "T3a": "100__112__13"}
+# bump when get_predictor() or its fixed settings change: the scores cached by
+# halving.py are recomputed
+PREDICTOR_VERSION = 1
+
+
+def _line_files(line_name):
+    pattern = f"daily_counts/YEAR=*/LINE={LINES[line_name]}/*"
+    return sorted(dataset_dir.glob(pattern))
 
 
 def load_usage(line_name):
+    # the filter on the LINE partition column means only that line's files
+    # are opened
     usage = (
-        pl.scan_parquet(data_dir / f"{line_name}.parquet")
-        .select(
-            pl.col("JOUR").alias("DATE"),
-            pl.col("NB_VALD")
-            .str.strip_chars()
-            .replace("Moins de 5", "4")
-            .cast(pl.Int32)
-            .alias("N"),
-        )
-        .group_by("DATE")
-        .agg(pl.col("N").sum())
+        pl.scan_parquet(dataset_dir / "daily_counts", hive_partitioning=True)
+        .filter(pl.col("LINE") == LINES[line_name])
+        .select(pl.col("DAY").alias("DATE"), pl.col("N").cast(pl.Int32))
         .sort("DATE")
     )
     return usage
 
 
-def regular_time_grid(usage, max_offset=0):
-    all_dates = usage.collect()["DATE"]
-    date_range = pl.date_range(
-        all_dates.min(),
-        all_dates.max() + timedelta(days=max_offset),
-        "1d",
-        eager=True,
-    )
-    dates = pl.LazyFrame({"DATE": date_range})
-    return dates.join(usage, on=["DATE"], how="left")
+def _single_series(usage, line_name=""):
+    # the feature engine works on several series at once, identified by LINE
+    return usage.with_columns(LINE=pl.lit(line_name))
 
 
-def add_lagged_features(usage):
-    lags = {
-        f"N_lag_{lag}": pl.col("N").shift(lag)
-        for lag in [3, 4, 5, 6, 7, 14, 21, 28, 35]
-    }
-    averages = {}
-    avg_lag = 3
-    for width in [3, 7, 30, 90]:
-        avg = pl.mean("N").rolling(
-            index_column="DATE", period=f"{width}d", offset=f"{- width - avg_lag}d"
-        )
-        averages[f"N_lag_{avg_lag}_avg_{width}"] = avg
-    usage = usage.with_columns(**lags, **averages)
-    return usage
-
-
-def add_datetime_features(usage):
-    return usage.with_columns(
-        pl.col("DATE").dt.year().alias("year"),
-        pl.col("DATE").dt.month().alias("month"),
-        pl.col("DATE").dt.day().alias("day"),
-        pl.col("DATE").dt.weekday().alias("weekday"),
-        pl.col("DATE").dt.ordinal_day().alias("day_of_year"),
+def regular_time_grid(usage, max_offset=0):
+    grid = line_time_grid(_single_series(usage), max_offset, time_col="DATE")
+    return grid.drop("LINE")
+
+
+def compute_features(line_name, *, lagged, school_holidays, holidays):
+    features = build_features(
+        _single_series(load_usage(line_name), line_name),
+        lagged=lagged,
+        school_holidays=(
+            pl.scan_parquet(dataset_dir / "school_holidays.parquet")
+            if school_holidays
+            else None
+        ),
+        holidays=(
+            pl.scan_parquet(dataset_dir / "holidays.parquet") if holidays else None
+        ),
+        time_col="DATE",
     )
+    return features.drop("LINE").collect()
+
+
+def data_fingerprint(line_name):
+    # changes when the files of the line or the holiday files change
+    content = ""
+    paths = [
+        *_line_files(line_name),
+        dataset_dir / "school_holidays.parquet",
+        dataset_dir / "holidays.parquet",
+    ]
+    for path in paths:
+        stat = path.stat()
+        name = path.relative_to(dataset_dir)
+        content += f"{name}: {stat.st_size} {stat.st_mtime_ns}\n"
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+
+def load_features(line_name, *, lagged, school_holidays, holidays):
+    # Only 8 combinations of the flags exist, so the search candidates and the
+    # joblib workers share one memory-mapped arrow file per combination instead
+    # of each recomputing (and pickling) the features.
+    if not FEATURE_CACHE:
+        return compute_features(
+            line_name, lagged=lagged, school_holidays=school_holidays, holidays=holidays
+        )
+    flags = "".join(str(int(f)) for f in (lagged, school_holidays, holidays))
+    # a new feature version or new input files give a new file name
+    key = f"{flags}-v{FEATURE_SCHEMA_VERSION}-{data_fingerprint(line_name)}"
+    path = cache_dir / f"{line_name}-{key}.arrow"
+    if not path.is_file():
+        cache_dir.mkdir(exist_ok=True)
+        with open(path.with_suffix(".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not path.is_file():
+                features = compute_features(
+                    line_name,
+                    lagged=lagged,
+                    school_holidays=school_holidays,
+                    holidays=holidays,
+                )
+                tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+                features.write_ipc(tmp_path, compression="uncompressed")
+                tmp_path.replace(path)
+                for stale in cache_dir.glob(f"{line_name}-{flags}-*.arrow"):
+                    if stale != path:
+                        stale.unlink(missing_ok=True)
+    return pl.read_ipc(path, memory_map=True)
 
 
-def add_school_holidays(usage):
-    holidays = pl.scan_parquet(data_dir / "school_holidays.parquet").filter(
-        pl.col("location") == "Paris", pl.col("population").is_in(["-", "Élèves"])
-    )
-    start = holidays.select(
-        DATE=pl.col("start_date").cast(pl.Date),
-        is_school_holiday=1,
-    )
-    end = holidays.select(
-        DATE=pl.col("end_date").cast(pl.Date),
-        is_school_holiday=0,
-    )
-    events = pl.concat([start, end]).sort("DATE")
-    return usage.join_asof(events, on="DATE").with_columns(
-        pl.col("is_school_holiday").fill_null(0)
+def add_features(dates, line_name, *, lagged, school_holidays, holidays):
+    features = load_features(
+        line_name, lagged=lagged, school_holidays=school_holidays, holidays=holidays
     )
+    return dates.join(features, on="DATE", how="left").drop("DATE")
+
+
+def get_choices():
+    # the searched hyperparameters, by name
+    return {
+        "use_lagged_features": skrub.choose_bool(name="use_lagged_features"),
+        "use_school_holidays": skrub.choose_bool(name="use_school_holidays"),
+        "use_holidays": skrub.choose_bool(name="use_holidays"),
+        "lr": skrub.choose_float(0.001, 0.8, log=True, name="lr"),
+        "max leaf nodes": skrub.choose_int(2, 65, log=True, name="max leaf nodes"),
+        "max bins": skrub.choose_int(3, 256, log=True, name="max bins"),
+        "min samples leaf": skrub.choose_int(1, 100, log=True, name="min samples leaf"),
+    }
 
 
-def add_holidays(usage):
-    holidays = pl.read_parquet(data_dir / "holidays.parquet")
-    return usage.with_columns(is_holiday=pl.col("DATE").is_in(holidays["date"]))
-
-
-def add_features(dates, line_name, *, lagged, school_holidays, holidays):
-    usage = load_usage(line_name)
-    usage = regular_time_grid(usage, 10)
-    usage = add_datetime_features(usage)
-    if lagged:
-        usage = add_lagged_features(usage)
-    if school_holidays:
-        usage = add_school_holidays(usage)
-    if holidays:
-        usage = add_holidays(usage)
-    usage = usage.drop("N").collect()
-    return dates.join(usage, on="DATE", how="left").drop("DATE")
-
-
-def get_predictor(line_name):
+def get_predictor(line_name, params=None):
+    # params fixes some of the choices to the given values, e.g. a candidate
+    # drawn by sample_params()
+    choices = {**get_choices(), **(params or {})}
     data = skrub.var("data")
     dates = data.select("DATE").skb.mark_as_X()
     counts = data["N"].skb.mark_as_y()
     X = skrub.deferred(add_features)(
         dates,
         line_name,
-        lagged=skrub.choose_bool(name="use_lagged_features"),
-        school_holidays=skrub.choose_bool(name="use_school_holidays"),
-        holidays=skrub.choose_bool(name="use_holidays"),
+        lagged=choices["use_lagged_features"],
+        school_holidays=choices["use_school_holidays"],
+        holidays=choices["use_holidays"],
     )
     hgb = HistGradientBoostingRegressor(
-        learning_rate=skrub.choose_float(0.001, 0.8, log=True, name="lr"),
-        max_leaf_nodes=skrub.choose_int(2, 65, log=True, name="max leaf nodes"),
-        max_bins=skrub.choose_int(3, 256, log=True, name="max bins"),
-        min_samples_leaf=skrub.choose_int(1, 100, log=True, name="min samples leaf"),
+        learning_rate=choices["lr"],
+        max_leaf_nodes=choices["max leaf nodes"],
+        max_bins=choices["max bins"],
+        min_samples_leaf=choices["min samples leaf"],
         early_stopping=True,
         n_iter_no_change=10,
         max_iter=1000,
@@ -127,48 +171,28 @@ def get_predictor(line_name):
     return pred
 
 
-def cv_split(data, gap=3, test_length=90, min_train_size=90):
-    split_dates = pl.date_range(
-        data["DATE"].min() + timedelta(days=min_train_size),
-        data["DATE"].max() - timedelta(days=gap),
-        interval=timedelta(days=test_length),
-        closed="left",
-        eager=True,
-    )
-    for split_d in split_dates:
-        train = (
-            data.with_row_index().filter(pl.col("DATE") < split_d)["index"].to_numpy()
-        )
-        test = (
-            data.with_row_index()
-            .filter(
-                (pl.col("DATE") >= split_d + timedelta(days=gap))
-                & (pl.col("DATE") < split_d + timedelta(days=test_length + gap))
-            )["index"]
-            .to_numpy()
-        )
-        if len(train) and len(test):
-            yield train, test
-
-
-class Splitter:
-    def __init__(self, max_splits=None, gap=3, test_length=90, min_train_size=90):
-        self.max_splits = max_splits
-        self.gap = gap
-        self.test_length = test_length
-        self.min_train_size = min_train_size
-
-    def split(self, X, y=None, groups=None):
-        splits = cv_split(
-            X,
-            gap=self.gap,
-            test_length=self.test_length,
-            min_train_size=self.min_train_size,
-        )
-        splits = list(splits)
-        if self.max_splits is None:
-            return splits
-        return splits[max(0, len(splits) - self.max_splits) :]
-
-    def get_n_splits(self, X, y=None, groups=None):
-        return len(self.split(X))
+def sample_params(n_iter, random_state=0):
+    # candidates drawn from the same distributions as the randomized search
+    rng = np.random.default_rng(random_state)
+    candidates = []
+    for _ in range(n_iter):
+        params = {}
+        for name, choice in get_choices().items():
+            if hasattr(choice, "outcomes"):
+                params[name] = choice.outcomes[rng.integers(len(choice.outcomes))]
+                continue
+            if choice.log:
+                value = np.exp(rng.uniform(np.log(choice.low), np.log(choice.high)))
+            else:
+                value = rng.uniform(choice.low, choice.high)
+            params[name] = int(round(value)) if choice.to_int else float(value)
+        candidates.append(params)
+    return candidates
+
+
+class Splitter(evaluation.Splitter):
+    # the time column of the subset data is DATE
+    def __init__(
+        self, max_splits=None, gap=3, test_length=90, min_train_size=90, time_col="DATE"
+    ):
+        super().__init__(max_splits, gap, test_length, min_train_size, time_col)
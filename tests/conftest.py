@@ -0,0 +1,27 @@
+from datetime import date
+from pathlib import Path
+import sys
+
+import duckdb
+import pytest
+
+# the scripts are top-level modules of the repository root
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+import generate_data  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def surface_database(tmp_path_factory):
+    # a database with the tables read by data_access.load_surface and the
+    # holiday tables; some lines open late or close early, and miss some days
+    database = tmp_path_factory.mktemp("data") / "ratp.duckdb"
+    tables = {
+        "daily_counts": generate_data.daily_counts(30, 400, first_day=date(2022, 1, 1)),
+        "school_holidays": generate_data.school_holidays(2021, 2023),
+        "holidays": generate_data.public_holidays(2022, 2023),
+    }
+    with duckdb.connect(database) as con:
+        for table_name, frame in tables.items():
+            con.sql(f"CREATE TABLE {table_name} AS SELECT * FROM frame")
+    return database
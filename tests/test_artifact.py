@@ -0,0 +1,63 @@
+import numpy as np
+import polars as pl
+import pytest
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.preprocessing import OrdinalEncoder
+
+import artifact
+
+
+def _features(n_rows, seed):
+    rng = np.random.default_rng(seed)
+    features = pl.DataFrame(
+        {
+            "DAY": np.arange(n_rows),
+            "LINE": rng.choice(["100__112__12", "100__112__13", "800__810__1"], n_rows),
+            "LINE_NAME": "T",
+            "N_lag_3": rng.normal(100, 30, n_rows),
+            "weekday": rng.integers(0, 7, n_rows),
+        }
+    )
+    # missing values, as for the first days of a line
+    return features.with_columns(
+        pl.when(pl.col("N_lag_3") > 130).then(None).otherwise(pl.col("N_lag_3"))
+    )
+
+
+@pytest.mark.parametrize("line_first", [True, False])
+def test_artifact_predicts_like_the_model(tmp_path, line_first):
+    features = _features(2000, 0)
+    encoder = OrdinalEncoder(
+        unknown_value=float("nan"), handle_unknown="use_encoded_value"
+    )
+    X = features.drop("DAY", "LINE_NAME").with_columns(
+        LINE=encoder.fit_transform(features.select("LINE"))[:, 0]
+    )
+    # the skrub pipeline of train.py moves the encoded LINE column to the end
+    columns = X.columns if line_first else [*X.columns[1:], "LINE"]
+    X = X.select(columns)
+    y = X["N_lag_3"].fill_null(0) * 2 + X["LINE"] * 50 + X["weekday"]
+    hgb = HistGradientBoostingRegressor(max_iter=30).fit(X, y)
+    schema = artifact.feature_schema(features)
+    artifact.export_model(hgb, encoder.categories_[0], schema, tmp_path)
+
+    model = artifact.load_model(schema, tmp_path)
+    test_features = _features(500, 1).with_columns(
+        LINE=pl.when(pl.col("DAY") < 10).then(pl.lit("unknown")).otherwise("LINE")
+    )
+    X_test = test_features.drop("DAY", "LINE_NAME").with_columns(
+        LINE=encoder.transform(test_features.select("LINE"))[:, 0]
+    )
+    np.testing.assert_allclose(
+        model.predict(test_features), hgb.predict(X_test.select(columns))
+    )
+
+
+def test_export_checks_the_feature_schema(tmp_path):
+    features = _features(200, 0)
+    X = features.select("N_lag_3", "weekday")
+    hgb = HistGradientBoostingRegressor(max_iter=5).fit(X, X["weekday"])
+    with pytest.raises(ValueError, match="feature schema"):
+        artifact.export_model(
+            hgb, ["100__112__12"], artifact.feature_schema(features), tmp_path
+        )
@@ -0,0 +1,164 @@
+from datetime import date
+from pathlib import Path
+import sys
+
+import duckdb
+import polars as pl
+from polars.testing import assert_frame_equal
+import pytest
+
+import data_access
+import generate_data
+
+
+def test_features_at_match_the_full_pipeline(surface_database):
+    con = data_access.connect(surface_database)
+    full = data_access.load_surface_features(con).collect()
+    keys = pl.concat(
+        [
+            full.select("DAY", "LINE").sample(300, seed=0),
+            # before a line's first day, after the grid extension, unknown line
+            pl.DataFrame(
+                {
+                    "DAY": [date(2021, 12, 1), date(2023, 12, 1), date(2022, 6, 1)],
+                    "LINE": ["100__112__12", "100__112__12", "unknown"],
+                }
+            ),
+        ]
+    )
+    expected = full.join(keys, on=["DAY", "LINE"], how="semi").sort("DAY", "LINE")
+    at = data_access.load_surface_features_at(con, keys)
+    assert at.height == 300
+    assert_frame_equal(at, expected)
+
+
+def test_features_at_the_edges_of_the_grid(surface_database):
+    # first days of each line (no history) and the days after its last count
+    con = data_access.connect(surface_database)
+    full = data_access.load_surface_features(con).collect()
+    edges = pl.concat(
+        [
+            full.group_by("LINE").agg(pl.col("DAY").sort().head(5)),
+            full.group_by("LINE").agg(pl.col("DAY").sort().tail(15)),
+        ]
+    ).explode("DAY")
+    expected = full.join(edges, on=["DAY", "LINE"], how="semi").sort("DAY", "LINE")
+    assert_frame_equal(data_access.load_surface_features_at(con, edges), expected)
+
+
+def test_features_at_datetime_keys(surface_database):
+    # e.g. a day from ibis' execute(), which returns a pandas Timestamp
+    con = data_access.connect(surface_database)
+    keys = pl.DataFrame({"DAY": [date(2022, 9, 1)], "LINE": ["100__112__12"]})
+    expected = data_access.load_surface_features_at(con, keys)
+    assert expected.height == 1
+    assert_frame_equal(
+        data_access.load_surface_features_at(
+            con, keys.with_columns(pl.col("DAY").cast(pl.Datetime("us")))
+        ),
+        expected,
+    )
+
+
+@pytest.fixture(scope="module")
+def surface_dataset(tmp_path_factory):
+    # a database with the raw surface table, and its export_dataset() copy
+    workdir = tmp_path_factory.mktemp("dataset")
+    database = workdir / "ratp.duckdb"
+    tables = {
+        "surface": generate_data.surface_validations(
+            12, 500, 3, first_day=date(2022, 1, 1)
+        ),
+        "school_holidays": generate_data.school_holidays(2021, 2023),
+        "holidays": generate_data.public_holidays(2022, 2023),
+    }
+    with duckdb.connect(database) as con:
+        for table_name, frame in tables.items():
+            con.sql(f"CREATE TABLE {table_name} AS SELECT * FROM frame")
+    dataset = workdir / "dataset"
+    data_access.export_dataset(data_access.connect(database), dataset)
+    return database, dataset
+
+
+def _surface(database, line=None):
+    counts = data_access.load_surface(data_access.connect(database))
+    if line is not None:
+        counts = counts.filter(counts.LINE == line)
+    return counts.to_polars().sort("DAY", "LINE")
+
+
+def test_dataset_matches_the_database(surface_dataset):
+    database, dataset = surface_dataset
+    assert_frame_equal(_surface(dataset), _surface(database))
+    for table_name in ["school_holidays", "holidays"]:
+        assert_frame_equal(
+            data_access.load_table(data_access.connect(dataset), table_name).collect(),
+            data_access.load_table(data_access.connect(database), table_name).collect(),
+        )
+
+
+def _break_other_lines(dataset, tmp_path):
+    # A copy of the dataset where the files of every line but the first one
+    # are unreadable. The first file is the one whose schema the readers take.
+    copy = tmp_path / "dataset"
+    files = sorted(dataset.rglob("*.parquet"))
+    first = next(path for path in files if "LINE=" in str(path))
+    line = first.parent.name.removeprefix("LINE=")
+    for path in files:
+        target = copy / path.relative_to(dataset)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if "LINE=" in str(path) and path.parent.name != first.parent.name:
+            target.write_bytes(b"not parquet")
+        else:
+            target.write_bytes(path.read_bytes())
+    return copy, line
+
+
+def test_dataset_filters_on_line_only_read_its_files(
+    surface_dataset, tmp_path, monkeypatch
+):
+    database, dataset = surface_dataset
+    copy, line = _break_other_lines(dataset, tmp_path)
+    with pytest.raises(Exception):
+        _surface(copy)
+    expected = _surface(database, line)
+    assert expected.height
+    assert_frame_equal(_surface(copy, line), expected)
+
+    # subset/ scans the same files with polars
+    sys.path.insert(0, str(Path(__file__).parents[1] / "subset"))
+    import utils
+
+    monkeypatch.setattr(utils, "dataset_dir", copy)
+    monkeypatch.setitem(utils.LINES, "T2", line)
+    usage = utils.load_usage("T2").collect()
+    assert usage["DATE"].to_list() == expected["DAY"].to_list()
+    assert usage["N"].to_list() == expected["N"].to_list()
+
+
+def test_fingerprint_follows_the_holiday_contents(tmp_path):
+    database = tmp_path / "ratp.duckdb"
+    counts = generate_data.daily_counts(3, 30, first_day=date(2022, 1, 1))
+    school_holidays = generate_data.school_holidays(2021, 2022)
+    holidays = generate_data.public_holidays(2022, 2022)
+    with duckdb.connect(database) as con:
+        for table_name in ["counts", "school_holidays", "holidays"]:
+            con.sql(f"CREATE TABLE {table_name} AS SELECT * FROM {table_name}")
+        con.sql("ALTER TABLE counts RENAME TO daily_counts")
+
+    def fingerprint():
+        con = data_access.connect(database)
+        try:
+            return data_access.data_fingerprint(con)
+        finally:
+            con.disconnect()
+
+    before = fingerprint()
+    assert fingerprint() == before
+    # same number of rows, another day
+    with duckdb.connect(database) as con:
+        con.sql(
+            "UPDATE holidays SET date = date + 1 "
+            "WHERE date = (SELECT min(date) FROM holidays)"
+        )
+    assert fingerprint() != before
@@ -0,0 +1,200 @@
+from datetime import date
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+
+import duckdb
+import numpy as np
+import polars as pl
+from polars.testing import assert_frame_equal
+import pytest
+
+import data_access
+import download
+import generate_data
+
+
+class _StandIn(BaseHTTPRequestHandler):
+    # the opendatasoft API: dataset listings and archives, with ETags and
+    # Range / If-Range support
+    def do_GET(self):
+        content = self.server.files[self.path]
+        etag = f'"{hashlib.sha256(content).hexdigest()}"'
+        start, status = 0, 200
+        if self.headers.get("If-None-Match") == etag:
+            status = 304
+        elif "Range" in self.headers and self.headers.get("If-Range") == etag:
+            start = int(self.headers["Range"].removeprefix("bytes=").rstrip("-"))
+            status = 206
+        self.server.log.append((self.path, status))
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        if status == 304:
+            self.end_headers()
+            return
+        if status == 206:
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}"
+            )
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StandIn)
+    root = f"http://127.0.0.1:{server.server_address[1]}"
+    server.log = []
+    server.files = {
+        "/archives/rf-2022.zip": b"rail 2022" * 100_000,
+        "/archives/rs-2022.zip": b"surface 2022" * 100_000,
+    }
+    for listing, key, archive in [
+        (download.RAIL_METADATA_URL, "reseau_ferre", "rf-2022.zip"),
+        (download.SURFACE_METADATA_URL, "reseau_de_surface", "rs-2022.zip"),
+    ]:
+        url = f"{root}/archives/{archive}"
+        server.files[f"/{listing}"] = json.dumps(
+            [{"annee": "2022", key: {"url": url}}]
+        ).encode()
+    monkeypatch.setattr(download, "API_ROOT", root)
+    monkeypatch.setattr(download, "OUT_DIR", tmp_path)
+    monkeypatch.setattr(download, "MANIFEST", tmp_path / "manifest.json")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _archive_statuses(server):
+    return sorted(status for path, status in server.log if "archives" in path)
+
+
+def test_download(stand_in, tmp_path):
+    download.download_data(n_jobs=2)
+    for name, archive in [("reseau_ferre", "rf"), ("reseau_de_surface", "rs")]:
+        content = (tmp_path / "2022" / f"{name}.zip").read_bytes()
+        assert content == stand_in.files[f"/archives/{archive}-2022.zip"]
+    assert _archive_statuses(stand_in) == [200, 200]
+    assert not list(tmp_path.glob("2022/*.part"))
+
+
+def test_unchanged_archives_are_skipped(stand_in, tmp_path):
+    download.download_data(n_jobs=2)
+    stand_in.log.clear()
+    download.download_data(n_jobs=2)
+    assert _archive_statuses(stand_in) == [304, 304]
+    # a modified archive is downloaded again
+    stand_in.files["/archives/rf-2022.zip"] = b"new rail 2022"
+    stand_in.log.clear()
+    download.download_data(n_jobs=2)
+    assert _archive_statuses(stand_in) == [200, 304]
+    assert (tmp_path / "2022" / "reseau_ferre.zip").read_bytes() == b"new rail 2022"
+
+
+def test_interrupted_download_is_resumed(stand_in, tmp_path):
+    url = f"{download.API_ROOT}/archives/rs-2022.zip"
+    content = stand_in.files["/archives/rs-2022.zip"]
+    out_file = tmp_path / "reseau_de_surface.zip"
+    part = tmp_path / "reseau_de_surface.zip.part"
+    part.write_bytes(content[:1000])
+    manifest = download._Manifest(download.MANIFEST)
+    etag = f'"{hashlib.sha256(content).hexdigest()}"'
+    manifest.update(url, partial_etag=etag)
+    download._fetch(download._session(1), manifest, url, out_file)
+    assert stand_in.log == [("/archives/rs-2022.zip", 206)]
+    assert out_file.read_bytes() == content
+    assert not part.exists()
+    assert manifest.get(url)["partial_etag"] is None
+
+
+def test_partial_file_of_a_modified_archive_is_discarded(stand_in, tmp_path):
+    url = f"{download.API_ROOT}/archives/rs-2022.zip"
+    out_file = tmp_path / "reseau_de_surface.zip"
+    part = tmp_path / "reseau_de_surface.zip.part"
+    part.write_bytes(b"old content")
+    manifest = download._Manifest(download.MANIFEST)
+    manifest.update(url, partial_etag='"old etag"')
+    download._fetch(download._session(1), manifest, url, out_file)
+    assert stand_in.log == [("/archives/rs-2022.zip", 200)]
+    assert out_file.read_bytes() == stand_in.files["/archives/rs-2022.zip"]
+
+
+def _validations(tmp_path):
+    staged = tmp_path / "2022_S1_NB_SURFACE.parquet"
+    pl.DataFrame(
+        {
+            "JOUR": [date(2022, 1, 1), date(2022, 1, 1), date(2022, 1, 2)],
+            "CODE_STIF_TRNS": ["100", "100", "100"],
+            "CODE_STIF_RES": ["112", "112", "112"],
+            "CODE_STIF_LIGNE": ["12", "12", "12"],
+            "LIBELLE_LIGNE": ["T2", "T2", "T2"],
+            "CATEGORIE_TITRE": ["NAVIGO", "TST", "NAVIGO"],
+            "NB_VALD": ["120", "Moins de 5", "80"],
+        }
+    ).write_parquet(staged)
+    return staged
+
+
+def _daily_counts(con):
+    return con.sql("SELECT DAY, N FROM daily_line_counts ORDER BY DAY").fetchall()
+
+
+def test_load_file_replaces_its_previous_version(tmp_path):
+    staged = _validations(tmp_path)
+    con = duckdb.connect()
+    download._create_ledger(con)
+    download._create_daily_line_counts(con)
+    for _ in range(2):
+        download._load_file(con, "surface", "2022/S1.txt", staged, "sha")
+    assert con.sql("SELECT count(*) FROM surface").fetchone() == (3,)
+    assert _daily_counts(con) == [(date(2022, 1, 1), 124), (date(2022, 1, 2), 80)]
+
+
+def test_rows_loaded_before_the_ledger_are_replaced(tmp_path):
+    # a database written before SOURCE_FILE and the ledger existed
+    staged = _validations(tmp_path)
+    con = duckdb.connect()
+    con.sql(f"CREATE TABLE surface AS SELECT * FROM read_parquet('{staged}')")
+    download._create_ledger(con)
+    download._create_daily_line_counts(con)
+    download._refresh_daily_line_counts(con, changed_days_only=False)
+    download._load_file(con, "surface", "2022/S1.txt", staged, "sha")
+    assert con.sql("SELECT count(*) FROM surface").fetchone() == (3,)
+    assert _daily_counts(con) == [(date(2022, 1, 1), 124), (date(2022, 1, 2), 80)]
+
+
+def test_daily_line_counts_match_the_raw_surface(tmp_path):
+    # load_surface() reads daily_line_counts when it exists and aggregates the
+    # surface table otherwise: both give the same frame, including the names
+    # of lines whose first rows have no name
+    rng = np.random.default_rng(0)
+    validations = generate_data.surface_validations(20, 60, 3)
+    names = rng.choice([None, "?", "keep"], validations.height, p=[0.3, 0.1, 0.6])
+    validations = validations.with_columns(
+        LIBELLE_LIGNE=pl.when(pl.Series(names) == "keep")
+        .then("LIBELLE_LIGNE")
+        .otherwise(pl.Series(names))
+    )
+    database = tmp_path / "ratp.duckdb"
+
+    def load_surface():
+        con = data_access.connect(database)
+        surface = data_access.load_surface(con).to_polars().sort("DAY", "LINE")
+        con.disconnect()
+        return surface
+
+    with duckdb.connect(database) as con:
+        con.sql("CREATE TABLE surface AS SELECT * FROM validations")
+    raw = load_surface()
+    with duckdb.connect(database) as con:
+        download._create_daily_line_counts(con)
+        download._refresh_daily_line_counts(con, changed_days_only=False)
+    assert raw["LINE_NAME"].null_count() < raw.height
+    assert_frame_equal(load_surface(), raw)
@@ -0,0 +1,104 @@
+from datetime import date, timedelta
+from pathlib import Path
+import sys
+
+import numpy as np
+import polars as pl
+import pytest
+
+import evaluation
+
+
+def _reference_cv_split(data, gap=3, test_length=90, min_train_size=90):
+    # the implementation that filtered the whole frame for every split
+    split_dates = pl.date_range(
+        data["DAY"].min() + timedelta(days=min_train_size),
+        data["DAY"].max() - timedelta(days=gap),
+        interval=timedelta(days=test_length),
+        closed="left",
+        eager=True,
+    )
+    for split_d in split_dates:
+        train = (
+            data.with_row_index().filter(pl.col("DAY") < split_d)["index"].to_numpy()
+        )
+        test = (
+            data.with_row_index()
+            .filter(
+                (pl.col("DAY") >= split_d + timedelta(days=gap))
+                & (pl.col("DAY") < split_d + timedelta(days=test_length + gap))
+            )["index"]
+            .to_numpy()
+        )
+        if len(train) and len(test):
+            yield train, test
+
+
+def _days(seed):
+    # several rows per day (lines), missing days, sorted or not
+    rng = np.random.default_rng(seed)
+    n_days = int(rng.integers(1, 1500))
+    n_rows = int(rng.integers(1, 3000))
+    offsets = np.sort(rng.integers(0, n_days, n_rows))
+    if rng.random() < 0.5:
+        rng.shuffle(offsets)
+    return pl.DataFrame(
+        {"DAY": [date(2015, 1, 1) + timedelta(days=int(d)) for d in offsets]}
+    )
+
+
+def _assert_same_splits(splits, expected):
+    assert len(splits) == len(expected)
+    for (train, test), (expected_train, expected_test) in zip(splits, expected):
+        np.testing.assert_array_equal(train, expected_train)
+        np.testing.assert_array_equal(test, expected_test)
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_cv_split_matches_the_reference(seed):
+    rng = np.random.default_rng(seed)
+    data = _days(seed)
+    params = {
+        "gap": int(rng.integers(0, 10)),
+        "test_length": int(rng.integers(1, 120)),
+        "min_train_size": int(rng.integers(1, 120)),
+    }
+    _assert_same_splits(
+        list(evaluation.cv_split(data, **params)),
+        list(_reference_cv_split(data, **params)),
+    )
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("max_splits", [None, 1, 4])
+def test_splitter_matches_the_reference(seed, max_splits):
+    data = _days(seed)
+    splitter = evaluation.Splitter(max_splits=max_splits)
+    expected = list(_reference_cv_split(data))
+    if max_splits is not None:
+        expected = expected[max(0, len(expected) - max_splits) :]
+    _assert_same_splits(splitter.split(data), expected)
+    assert splitter.get_n_splits(data) == len(expected)
+    if data["DAY"].is_sorted():
+        slices = [
+            (np.arange(len(data))[train], np.arange(len(data))[test])
+            for train, test in splitter.split_slices(data)
+        ]
+        _assert_same_splits(slices, expected)
+
+
+def test_split_slices_needs_sorted_data():
+    data = pl.DataFrame({"DAY": [date(2020, 1, 1) + timedelta(days=d) for d in [5, 1]]})
+    with pytest.raises(ValueError, match="sorted by DAY"):
+        evaluation.Splitter().split_slices(data)
+
+
+def test_subset_splitter_uses_the_date_column():
+    sys.path.insert(0, str(Path(__file__).parents[1] / "subset"))
+    import utils
+
+    data = _days(0)
+    _assert_same_splits(
+        utils.Splitter(max_splits=3).split(data.rename({"DAY": "DATE"})),
+        evaluation.Splitter(max_splits=3).split(data),
+    )
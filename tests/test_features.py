@@ -0,0 +1,73 @@
+from datetime import date, timedelta
+
+import polars as pl
+from polars.testing import assert_frame_equal
+import pytest
+
+import features
+
+# line A is observed on days 1, 2, 3, 5 and 6 (day 4 is missing), line B on
+# days 3 and 4; the grid of each line ends GRID_EXTENSION_DAYS after its last
+# observation
+COUNTS = {"A": {1: 10, 2: 20, 3: 30, 5: 50, 6: 60}, "B": {3: 100, 4: 200}}
+# hand-computed, by line and day, for lags 1 and 2 and widths 1 and 2 of the
+# mean lagged by AVG_LAG = 3: N_lag_3_avg_w of day t is the mean of the
+# observed counts of days t - 3 - w to t - 3
+EXPECTED = {
+    "A": {
+        "N_lag_1": {2: 10, 3: 20, 4: 30, 6: 50, 7: 60},
+        "N_lag_2": {3: 10, 4: 20, 5: 30, 7: 50, 8: 60},
+        "N_lag_3_avg_1": {4: 10, 5: 15, 6: 25, 7: 30, 8: 50, 9: 55, 10: 60},
+        "N_lag_3_avg_2": {4: 10, 5: 15, 6: 20, 7: 25, 8: 40, 9: 55, 10: 55, 11: 60},
+    },
+    "B": {
+        "N_lag_1": {4: 100, 5: 200},
+        "N_lag_2": {5: 100, 6: 200},
+        "N_lag_3_avg_1": {6: 100, 7: 150, 8: 200},
+        "N_lag_3_avg_2": {6: 100, 7: 150, 8: 150, 9: 200},
+    },
+}
+
+
+def _day(offset):
+    return date(2023, 1, 1) + timedelta(days=offset - 1)
+
+
+def _counts():
+    rows = [
+        (_day(d), line, n) for line, days in COUNTS.items() for d, n in days.items()
+    ]
+    return pl.DataFrame(rows, schema=["DAY", "LINE", "N"], orient="row")
+
+
+def _expected(column):
+    rows = []
+    for line, days in COUNTS.items():
+        last_day = max(days) + features.GRID_EXTENSION_DAYS
+        for d in range(min(days), last_day + 1):
+            value = EXPECTED[line][column].get(d)
+            rows.append((_day(d), line, None if value is None else float(value)))
+    return pl.DataFrame(
+        rows, schema=["DAY", "LINE", column], orient="row"
+    ).sort("DAY", "LINE")
+
+
+def test_grid_spans_each_line_and_the_extension():
+    grid = features.line_time_grid(_counts()).collect()
+    spans = grid.group_by("LINE").agg(
+        first=pl.col("DAY").min(), last=pl.col("DAY").max(), n=pl.len()
+    )
+    assert spans.sort("LINE").rows() == [
+        ("A", _day(1), _day(16), 16),
+        ("B", _day(3), _day(14), 12),
+    ]
+    # the missing day and the extension are on the grid, without a count
+    assert grid.filter(pl.col("N").is_null()).height == 16 + 12 - 7
+
+
+@pytest.mark.parametrize("column", list(EXPECTED["A"]))
+def test_lagged_feature_windows(column):
+    frame = features.build_features(_counts(), lags=[1, 2], avg_widths=[1, 2])
+    result = frame.select("DAY", "LINE", column).collect()
+    expected = _expected(column)
+    assert_frame_equal(result, expected, check_dtypes=False)
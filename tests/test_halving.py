@@ -0,0 +1,56 @@
+from pathlib import Path
+import sys
+
+import numpy as np
+import polars as pl
+import pytest
+
+optuna = pytest.importorskip("optuna")
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "subset"))
+import halving  # noqa: E402
+
+
+@pytest.fixture
+def scored(monkeypatch):
+    # score_fold without fitting: the score is a function of the parameters,
+    # and the (parameters, fold) pairs are recorded
+    calls = []
+
+    def score_fold(line_name, params, train_data, test_data):
+        calls.append((params["lr"], train_data.height))
+        return -params["lr"] - 0.01 * train_data.height, False
+
+    monkeypatch.setattr(halving, "score_fold", score_fold)
+    monkeypatch.setattr(halving, "_data_key", lambda line_name: "data")
+    return calls
+
+
+def _folds():
+    usage = pl.DataFrame({"DATE": np.arange(40), "N": np.arange(40)})
+    folds = [(slice(0, n), slice(n, n + 5)) for n in [30, 20, 10]]
+    return usage, folds
+
+
+def test_interrupted_optuna_trials_are_rerun(scored):
+    usage, folds = _folds()
+    storage = optuna.storages.InMemoryStorage()
+    study = optuna.create_study(
+        study_name="T2-data", direction="maximize", storage=storage
+    )
+    study.optimize(lambda trial: -halving._suggest(trial)["lr"], n_trials=2)
+    # a search killed in the middle of a trial leaves it RUNNING
+    stale = study.ask()
+    stale_params = halving._suggest(stale)
+
+    halving._optuna("T2", usage, folds, 5, 1, storage, optuna.pruners.NopPruner())
+
+    states = [t.state for t in study.get_trials()]
+    assert states.count(optuna.trial.TrialState.FAIL) == 1
+    assert states.count(optuna.trial.TrialState.RUNNING) == 0
+    assert states.count(optuna.trial.TrialState.COMPLETE) == 5
+    rerun = study.get_trials()[3]
+    assert rerun.params == stale_params
+    assert rerun.state == optuna.trial.TrialState.COMPLETE
+    # the first trial of the resumed search is the interrupted candidate
+    assert scored[: len(folds)] == [(stale_params["lr"], n) for n in [30, 20, 10]]
@@ -0,0 +1,107 @@
+from datetime import date, timedelta
+import pickle
+
+import ibis
+import polars as pl
+from polars.testing import assert_frame_equal
+import pytest
+
+from features import GRID_EXTENSION_DAYS
+import generate_data
+import rail
+
+N_BUCKETS = 4
+# of "100__110__8738400" and "800__810__1" among 64 buckets
+EXPECTED_BUCKETS = [60, 36]
+
+
+@pytest.fixture(scope="module")
+def rail_models(tmp_path_factory):
+    # stop counts exported to N_BUCKETS buckets and one model per bucket
+    workdir = tmp_path_factory.mktemp("rail")
+    counts = generate_data.daily_counts(20, 300, first_day=date(2022, 1, 1)).rename(
+        {"LINE": "STOP", "LINE_NAME": "STOP_NAME"}
+    )
+    database = workdir / "rail.duckdb"
+    con = ibis.duckdb.connect(database)
+    con.create_table("school_holidays", generate_data.school_holidays(2021, 2023))
+    con.create_table("holidays", generate_data.public_holidays(2022, 2023))
+    data_dir = workdir / "rail_stops"
+    rail.export_stop_counts(con, ibis.memtable(counts), data_dir, N_BUCKETS)
+    con.disconnect()
+    model_dir = workdir / "models"
+    rail.train(1, database, data_dir, model_dir)
+    return database, data_dir, model_dir, counts
+
+
+def _keys(counts):
+    spans = counts.group_by("STOP").agg(last_day=pl.col("DAY").max())
+    keys = (
+        counts.select("DAY", "STOP")
+        .sample(100, seed=0)
+        .vstack(
+            spans.select(
+                DAY=pl.col("last_day") + timedelta(days=GRID_EXTENSION_DAYS),
+                STOP="STOP",
+            )
+        )
+    )
+    # an unknown stop, and a day after the grid of its stop
+    outside = pl.DataFrame(
+        {
+            "DAY": [date(2022, 6, 1), date(2030, 1, 1)],
+            "STOP": ["unknown", counts["STOP"][0]],
+        }
+    )
+    return keys.vstack(outside), keys.unique().height
+
+
+def test_predictions_match_the_bucket_models(rail_models):
+    database, data_dir, model_dir, counts = rail_models
+    keys, n_known = _keys(counts)
+    predictions = rail.predict(keys, database, data_dir, model_dir)
+    assert predictions.height == n_known
+
+    con = rail.connect(database)
+    expected = []
+    for bucket in rail.buckets(data_dir):
+        features = rail.load_stop_features(con, bucket, data_dir).collect()
+        features = features.join(keys, on=["DAY", "STOP"], how="semi")
+        if features.is_empty():
+            continue
+        with open(model_dir / f"bucket-{bucket:03d}.pickle", "rb") as stream:
+            fitted = pickle.load(stream)
+        assert fitted["cv_mape"] is not None
+        expected.append(
+            features.select("DAY", "STOP").with_columns(
+                prediction=rail._predict(fitted, features.drop("STOP_NAME"))
+            )
+        )
+    assert_frame_equal(predictions, pl.concat(expected).sort("DAY", "STOP"))
+
+
+def test_stops_are_hashed_to_their_bucket(rail_models):
+    database, data_dir, model_dir, counts = rail_models
+    assert rail.bucket_count(data_dir) == N_BUCKETS
+    for bucket in rail.buckets(data_dir):
+        stops = rail.load_stop_counts(bucket, data_dir).collect()["STOP"].unique()
+        buckets = rail.stop_buckets(stops, N_BUCKETS)
+        assert buckets["BUCKET"].to_list() == [bucket] * len(stops)
+    # fixed values: a change of hash would move every stop to another bucket
+    buckets = rail.stop_buckets(["100__110__8738400", "800__810__1"], 64)
+    assert buckets["BUCKET"].to_list() == EXPECTED_BUCKETS
+    predictions = rail.predict(
+        pl.DataFrame({"DAY": [date(2022, 6, 1)], "STOP": ["unknown"]}),
+        database,
+        data_dir,
+        model_dir,
+    )
+    assert predictions.is_empty()
+
+
+def test_predict_needs_the_export_metadata(rail_models, tmp_path):
+    database, data_dir, model_dir, counts = rail_models
+    old_export = tmp_path / "rail_stops"
+    old_export.mkdir()
+    with pytest.raises(ValueError, match="export again"):
+        rail.predict(counts.select("DAY", "STOP"), database, old_export, model_dir)
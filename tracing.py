@@ -0,0 +1,124 @@
+"""Stage timings written as a Chrome trace.
+
+Enabled by setting RATP_TRACE to the output file, or with --trace in
+download.py and train.py; open the result in https://ui.perfetto.dev or
+chrome://tracing. Each stage is one event with its wall time, the resident
+memory of the process at its start and end and, where the caller knows them,
+rows in and out. The kernel only keeps the peak of the whole process, so a
+stage reports peak_rss_mib only when it raised that peak (it is then the peak
+of the stage); max_rss_so_far_mib is always the peak of the process so far.
+
+Worker processes inherit the variable and append to the same file, so the
+parallel parsing of download.py and the cross-validation folds show up as
+separate tracks. Queries run inside duckdb_profile() also write DuckDB's JSON
+profile next to the trace.
+"""
+import contextlib
+import functools
+import json
+import os
+from pathlib import Path
+import resource
+import threading
+import time
+
+ENV_VAR = "RATP_TRACE"
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def trace_file():
+    path = os.environ.get(ENV_VAR)
+    return Path(path) if path else None
+
+
+def start(path):
+    # called once by the script: empties the trace and enables it in the
+    # processes started from now on
+    path = Path(path).resolve()
+    os.environ[ENV_VAR] = str(path)
+    path.write_text("[\n")
+
+
+def _append(event):
+    # Chrome's JSON array format does not need the closing bracket, so every
+    # event is a single append and concurrent processes do not clash
+    with open(trace_file(), "a") as stream:
+        if stream.tell() == 0:
+            stream.write("[\n")
+        stream.write(json.dumps(event, default=str) + ",\n")
+
+
+def _rss_mib():
+    # resident set size now, None where /proc is not available
+    try:
+        with open("/proc/self/statm") as stream:
+            pages = int(stream.read().split()[1])
+    except OSError:
+        return None
+    return round(pages * PAGE_SIZE / 2**20, 1)
+
+
+def _max_rss_mib():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+@contextlib.contextmanager
+def stage(name, **args):
+    # yields a dict the caller can fill (e.g. rows_out) before the event is
+    # written
+    if trace_file() is None:
+        yield args
+        return
+    timestamp = time.time()
+    rss_start = _rss_mib()
+    max_rss_start = _max_rss_mib()
+    start_time = time.perf_counter()
+    try:
+        yield args
+    finally:
+        duration = time.perf_counter() - start_time
+        memory = {
+            "rss_start_mib": rss_start,
+            "rss_end_mib": _rss_mib(),
+            "max_rss_so_far_mib": _max_rss_mib(),
+        }
+        if memory["max_rss_so_far_mib"] > max_rss_start:
+            memory["peak_rss_mib"] = memory["max_rss_so_far_mib"]
+        _append(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": timestamp * 1e6,
+                "dur": duration * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {**args, **memory},
+            }
+        )
+
+
+def traced(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(f"{func.__module__}.{func.__name__}"):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def duckdb_profile(con, name, **args):
+    # stage() that also writes the JSON profile of the query run inside it
+    # (the last one if there are several); con is an ibis duckdb backend
+    path = trace_file()
+    if path is None:
+        yield args
+        return
+    profile = path.with_name(f"{path.stem}.{name}.{os.getpid()}.profile.json")
+    con.con.execute("PRAGMA enable_profiling = 'json'")
+    con.con.execute(f"PRAGMA profiling_output = '{profile}'")
+    try:
+        with stage(name, profile=str(profile), **args) as info:
+            yield info
+    finally:
+        con.con.execute("PRAGMA disable_profiling")
@@ -1,50 +1,103 @@
 import argparse
+import datetime
+import hashlib
+import json
+import os
+from pathlib import Path
 import pickle
+import shutil
 
+from joblib import Parallel, delayed
 import polars as pl
-import ibis
 from ibis import _
 from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.metrics import mean_absolute_percentage_error
 from sklearn.preprocessing import OrdinalEncoder
 import skrub
 
-from data_access import load_surface, load_surface_features
-from evaluation import Splitter
+from data_access import (
+    DATABASE,
+    connect,
+    data_fingerprint,
+    load_cached_surface_features,
+    load_surface,
+    read_surface_features,
+)
+from artifact import export_model, feature_schema
+from evaluation import Splitter, errors_per_line
+import tracing
 
 T2 = "100__112__12"
-USE_T2_ONLY = True
+STATE_FILE = Path("training-state.json")
+# --update reruns the search when it is older than this or when the error on
+# the new days exceeds DRIFT_TOLERANCE times the cross-validation error
+SEARCH_MAX_AGE_DAYS = 30
+DRIFT_TOLERANCE = 1.5
 parser = argparse.ArgumentParser()
 parser.add_argument("--cross_validate", action="store_true")
 parser.add_argument("--report", action="store_true")
+parser.add_argument("--n_jobs", type=int, default=-1)
+parser.add_argument("--resume", action="store_true")
+# one global model over all lines instead of T2 only; the LINE column is
+# ordinal-encoded so the model can tell the series apart
+parser.add_argument("--all_lines", action="store_true")
+parser.add_argument("--max_lines", type=int, default=None, help="busiest lines only")
+# refit best-model.pickle with its hyperparameters on the data received since
+# the last run
+parser.add_argument("--update", action="store_true")
+parser.add_argument("--window_days", type=int, default=None)
+# stage timings (also of the parallel folds) as a Chrome trace, see tracing.py
+parser.add_argument("--trace", default=None)
 cl_args = parser.parse_args()
+if cl_args.trace is not None:
+    tracing.start(cl_args.trace)
+if cl_args.update:
+    # the model is refitted on the lines it was trained on, whatever the flags
+    state = json.loads(STATE_FILE.read_text()) if STATE_FILE.is_file() else {}
+    if "line_selection" not in state:
+        parser.error(
+            f"--update needs the {STATE_FILE} written along with best-model.pickle "
+            "by this version of train.py: run train.py without --update first"
+        )
+    cl_args.all_lines = state["line_selection"]["all_lines"]
+    cl_args.max_lines = state["line_selection"]["max_lines"]
 
 
-connection = ibis.duckdb.connect("data/ratp.duckdb", read_only=True)
+connection = connect()
 all_days_df = load_surface(connection)
 
-if USE_T2_ONLY:
+if cl_args.max_lines is not None:
+    busiest = (
+        all_days_df.group_by("LINE")
+        .aggregate(total=_.N.sum())
+        .order_by(_.total.desc())
+        .limit(cl_args.max_lines)
+    )
+    all_days_df = all_days_df.filter(_.LINE.isin(busiest.LINE))
+elif not cl_args.all_lines:
     all_days_df = all_days_df.filter(_.LINE == T2)
 
-all_days_df = all_days_df.to_polars()
+with tracing.stage("train.load_surface") as trace:
+    all_days_df = all_days_df.to_polars()
+    trace["rows_out"] = all_days_df.height
+print(f"{all_days_df['LINE'].n_unique()} lines, {all_days_df.height:,} days x lines")
 
 # %%
 all_days = skrub.var("all_days", all_days_df)
 X = all_days.select(["DAY", "LINE"]).skb.mark_as_X()
 y = all_days["N"].skb.mark_as_y()
 
-con = skrub.var("connection", connection)
-X = skrub.deferred(ibis.memtable)(X)
-features = skrub.deferred(load_surface_features)(con).skb.set_name("features")
+database = skrub.var("database", str(DATABASE))
+features = skrub.deferred(read_surface_features)(database).skb.set_name("features")
 X = (
-    X.join(features, [X.DAY == features.DAY, X.LINE == features.LINE])
-    .order_by(["DAY", "LINE"])
+    X.join(features, on=["DAY", "LINE"], how="inner")
+    .sort(["DAY", "LINE"])
     .drop(["DAY", "LINE_NAME"])
-    .to_polars()
 )
 X = X.skb.apply(
     OrdinalEncoder(unknown_value=float("nan"), handle_unknown="use_encoded_value"),
     cols="LINE",
-)
+).skb.set_name("line_encoder")
 
 # %%
 hgb = HistGradientBoostingRegressor(
@@ -56,7 +109,7 @@ hgb = HistGradientBoostingRegressor(
     n_iter_no_change=10,
     max_iter=1000,
 )
-prediction = X.skb.apply(hgb, y=y)
+prediction = X.skb.apply(hgb, y=y).skb.set_name("hgb")
 
 # %%
 if cl_args.report:
@@ -64,57 +117,167 @@ if cl_args.report:
 
 # %%
 
-# Note: ibis tables cannot be passed to subprocesses; to use n_jobs we would
-# have to do the join in polars
-features_df = load_surface_features(connection).cache()
+# computed once here; the pipeline's features node (run by the joblib workers)
+# then only opens the database and memory-maps the cached table
+with tracing.stage("train.features") as trace:
+    features_df = load_cached_surface_features(connection)
+    trace["rows_out"] = features_df.height
 
 # %%
 
 
-def get_cv_predictions():
-    all_test_data = []
-    for i, (train, test) in enumerate(Splitter().split(all_days_df)):
-        print(f"=================== fold {i} ========================")
-        est = prediction.skb.get_randomized_search(
-            cv=Splitter(min_train_size=60 if i == 0 else 90, max_splits=4),
-            verbose=1,
-            n_iter=8,
-            scoring="neg_mean_absolute_percentage_error",
-        )
-        est.fit(
-            {
-                "all_days": all_days_df.select(pl.all().gather(train)),
-                "features": features_df,
-            }
-        )
-        test_data = all_days_df.select(pl.all().gather(test))
-        pred = est.predict({"all_days": test_data, "features": features_df})
-        all_test_data.append(test_data.with_columns(predicted=pred))
-        print(est.get_cv_results_table())
-        print()
+CV_PARTS_DIR = Path("cv_predictions.parts")
+
+
+def _part_path(i, train_data, test_data, fingerprint):
+    # a finished part is only reused for the same fold (dates and rows) of the
+    # same data
+    fold = [
+        train_data["DAY"].min(),
+        train_data["DAY"].max(),
+        test_data["DAY"].min(),
+        test_data["DAY"].max(),
+        train_data.height,
+        test_data.height,
+        fingerprint,
+    ]
+    key = hashlib.sha256("_".join(map(str, fold)).encode("utf-8")).hexdigest()[:16]
+    return CV_PARTS_DIR / f"fold-{i:03d}-{key}.parquet"
 
-    results = pl.concat(all_test_data)
+
+def fit_fold(prediction, i, train_data, test_data, part):
+    print(f"=================== fold {i} ========================")
+    # outer folds already run in parallel, the nested search uses one core
+    est = prediction.skb.get_randomized_search(
+        cv=Splitter(min_train_size=60 if i == 0 else 90, max_splits=4),
+        verbose=1,
+        n_iter=8,
+        n_jobs=1,
+        scoring="neg_mean_absolute_percentage_error",
+    )
+    with tracing.stage("train.fold", fold=i, rows_in=train_data.height):
+        est.fit({"all_days": train_data, "database": str(DATABASE)})
+        pred = est.predict({"all_days": test_data, "database": str(DATABASE)})
+    print(est.get_cv_results_table())
+    print()
+    # written as soon as the fold is done so a crash does not lose it, and
+    # renamed once complete so that --resume never sees a truncated part
+    tmp_part = part.with_name(f"{part.name}.{os.getpid()}.tmp")
+    test_data.with_columns(predicted=pred).write_parquet(tmp_part)
+    tmp_part.replace(part)
+    return i
+
+
+def get_cv_predictions(n_jobs=-1, resume=False):
+    if not resume:
+        shutil.rmtree(CV_PARTS_DIR, ignore_errors=True)
+    CV_PARTS_DIR.mkdir(exist_ok=True)
+    splits = Splitter().split_slices(all_days_df)
+    fingerprint = data_fingerprint(connection)
+    folds = [(all_days_df[train], all_days_df[test]) for train, test in splits]
+    parts = [
+        _part_path(i, train_data, test_data, fingerprint)
+        for i, (train_data, test_data) in enumerate(folds)
+    ]
+    # parts of other folds or other data, and unfinished ones, are discarded
+    for path in CV_PARTS_DIR.iterdir():
+        if path not in parts:
+            print(f"discarding {path.name}")
+            path.unlink()
+    todo = [
+        delayed(fit_fold)(prediction, i, train_data, test_data, part)
+        for i, ((train_data, test_data), part) in enumerate(zip(folds, parts))
+        if not part.is_file()
+    ]
+    for i in Parallel(n_jobs=n_jobs, return_as="generator_unordered")(todo):
+        print(f"fold {i} done")
+    results = pl.concat(pl.read_parquet(part) for part in parts)
     return results
 
 
-if cl_args.cross_validate:
+@tracing.traced
+def save_model(model, train_data, cv_mape=None):
+    with open("best-model.pickle", "wb") as stream:
+        pickle.dump(model, stream)
+    # the fitted trees alone, for fast-starting prediction processes, with the
+    # LINE categories of the fitted encoder
+    encoder = model.find_fitted_estimator("line_encoder").transformer_
+    export_model(
+        model.find_fitted_estimator("hgb"),
+        encoder.categories_[0],
+        feature_schema(features_df),
+    )
+    state = json.loads(STATE_FILE.read_text()) if STATE_FILE.is_file() else {}
+    state["last_day"] = str(train_data["DAY"].max())
+    state["line_selection"] = {
+        "all_lines": cl_args.all_lines,
+        "max_lines": cl_args.max_lines,
+    }
+    if cv_mape is not None:
+        state["search_date"] = str(datetime.date.today())
+        state["cv_mape"] = cv_mape
+    STATE_FILE.write_text(json.dumps(state, indent=2))
 
-    results = get_cv_predictions()
-    results.write_parquet("cv_predictions.parquet")
 
-else:
+def search_model():
     estimator = prediction.skb.get_randomized_search(
         cv=Splitter(max_splits=10),
         verbose=1,
         n_iter=16,
+        n_jobs=cl_args.n_jobs,
         scoring="neg_mean_absolute_percentage_error",
     )
-    estimator.fit({"all_days": all_days_df, "features": features_df})
+    with tracing.stage("train.search", rows_in=all_days_df.height, n_iter=16):
+        # workers get the database path, not the feature table
+        estimator.fit({"all_days": all_days_df, "database": str(DATABASE)})
     print(estimator.get_cv_results_table())
 
     # %%
     with open("search-model.pickle", "wb") as stream:
         pickle.dump(estimator, stream)
 
-    with open("best-model.pickle", "wb") as stream:
-        pickle.dump(estimator.best_estimator_, stream)
+    save_model(estimator.best_estimator_, all_days_df, cv_mape=-estimator.best_score_)
+
+
+def update_model(window_days=None):
+    state = json.loads(STATE_FILE.read_text())
+    with open("best-model.pickle", "rb") as stream:
+        model = pickle.load(stream)
+    last_day = datetime.date.fromisoformat(state["last_day"])
+    new_days = all_days_df.filter(pl.col("DAY") > last_day)
+    if new_days.is_empty():
+        print(f"No data after {last_day}, nothing to do")
+        return
+    pred = model.predict({"all_days": new_days, "database": str(DATABASE)})
+    mape = mean_absolute_percentage_error(new_days["N"], pred)
+    print(f"{new_days['DAY'].n_unique()} new days, MAPE: {mape:.1%}")
+    search_date = datetime.date.fromisoformat(state["search_date"])
+    search_age = (datetime.date.today() - search_date).days
+    if search_age > SEARCH_MAX_AGE_DAYS or mape > DRIFT_TOLERANCE * state["cv_mape"]:
+        print(f"Search is {search_age} days old, CV MAPE was {state['cv_mape']:.1%}")
+        print("Running the hyperparameter search again")
+        search_model()
+        return
+    # same hyperparameters, refit on the (possibly truncated) history
+    train_data = all_days_df
+    if window_days is not None:
+        start = all_days_df["DAY"].max() - datetime.timedelta(days=window_days)
+        train_data = train_data.filter(pl.col("DAY") > start)
+    with tracing.stage("train.refit", rows_in=train_data.height):
+        model.fit({"all_days": train_data, "database": str(DATABASE)})
+    save_model(model, train_data)
+
+
+if cl_args.cross_validate:
+
+    results = get_cv_predictions(cl_args.n_jobs, cl_args.resume)
+    results.write_parquet("cv_predictions.parquet")
+    errors = errors_per_line(results)
+    errors.write_csv("cv_errors_per_line.csv")
+    print(errors)
+
+elif cl_args.update:
+    update_model(cl_args.window_days)
+
+else:
+    search_model()